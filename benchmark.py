@@ -0,0 +1,126 @@
+import os
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import xarray as xr
+from syn_sar import *
+from syn_sar import _read_stats_img
+
+# Benchmarks for the synthesis hot path. Run from the repository root:
+#   python benchmark.py kernel --sizes 2000 5000
+#   python benchmark.py scaling --threads 1 2 4 8 --sizes 10000
+
+def legacy_synthesis(sm, est_tpc, all_meanVV, dry_meanVV, dry_stdVV, zscore_threshold):
+    # The original synthesize_sar formulation, kept as the reference
+    for ct_mode in range(sm.shape[2]):
+        if ct_mode == 0:
+            syn_sar = sm[:,:,ct_mode]*est_tpc[ct_mode]
+        else:
+            syn_sar = syn_sar + sm[:,:,ct_mode]*est_tpc[ct_mode]
+    syn_sar = syn_sar + all_meanVV
+    z_score_img = (syn_sar-dry_meanVV)/dry_stdVV
+    aoi_indx = np.argwhere(~np.isnan(dry_meanVV))
+    water_indx = np.argwhere( z_score_img < zscore_threshold )
+    water_map = np.empty((syn_sar.shape[0], syn_sar.shape[1]))
+    water_map[:] = 0
+    water_map[aoi_indx[:,0], aoi_indx[:,1]] = 0
+    water_map[water_indx[:,0], water_indx[:,1]] = 1
+    return syn_sar, z_score_img, water_map
+
+def synthetic_inputs(n_lat, n_lon, n_mode=4, seed=0, dtype='float64'):
+    rng = np.random.default_rng(seed)
+    sm = rng.normal(0, 3e-3, (n_lat, n_lon, n_mode)).astype(dtype)
+    all_meanVV = rng.normal(-13, 1.5, (n_lat, n_lon)).astype(dtype)
+    dry_meanVV = all_meanVV + 1
+    dry_stdVV = np.abs(rng.normal(1.5, 0.3, (n_lat, n_lon))).astype(dtype) + 0.3
+    # Pixels outside an elliptical AOI are NaN like the real stats images
+    lat, lon = np.ogrid[-1:1:n_lat*1j, -1:1:n_lon*1j]
+    outside = lat**2 + lon**2 > 0.8
+    dry_meanVV[outside] = np.nan
+    dry_stdVV[outside] = np.nan
+    est_tpc = rng.normal(0, 400, n_mode)
+    return sm, est_tpc, all_meanVV, dry_meanVV, dry_stdVV, -1.5
+
+def region_inputs(region):
+    RSM = xr.open_dataset(asset_path(region, 'RSM', 'RSM_hydro.nc'), engine="h5netcdf")
+    sm = RSM.spatial_modes.values
+    RSM.close()
+    est_tpc = np.random.default_rng(0).normal(0, 400, sm.shape[2])
+    return sm, est_tpc, _read_stats_img(region, 'all_meanVV'), _read_stats_img(region, 'dry_meanVV'), _read_stats_img(region, 'dry_stdVV'), -1.5
+
+def measure(func, *args, repeat=3, **kwargs):
+    # (best wall time in s, peak traced allocation in MB) of func(*args)
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best, peak/2**20
+
+def fused_synthesis(sm, est_tpc, all_meanVV, dry_meanVV, dry_stdVV, zscore_threshold):
+    # Packing to the AOI pixels happens once per region, so it is not timed
+    assets = RegionAssets(None, None, None, np.moveaxis(sm, -1, 0), all_meanVV, dry_meanVV, dry_stdVV)
+    def run():
+        syn_sar, z_score_img, water_map = synthesis_kernel(assets.modes, est_tpc, assets.all_meanVV, assets.dry_meanVV, assets.dry_stdVV, zscore_threshold)
+        return assets.to_grid(syn_sar), assets.to_grid(z_score_img), assets.to_grid(water_map, 0)
+    return run
+
+def bench_kernel(cases, repeat):
+    print('%-22s %12s %12s %12s %12s %8s' % ('grid', 'legacy [ms]', 'fused [ms]', 'legacy [MB]', 'fused [MB]', 'speedup'))
+    for name, inputs in cases:
+        fused = fused_synthesis(*inputs)
+        legacy_time, legacy_peak = measure(legacy_synthesis, *inputs, repeat=repeat)
+        fused_time, fused_peak = measure(fused, repeat=repeat)
+        assert np.array_equal(legacy_synthesis(*inputs)[2], fused()[2]), 'inundation maps differ for %s' % name
+        print('%-22s %12.1f %12.1f %12.1f %12.1f %7.2fx' % (name, legacy_time*1e3, fused_time*1e3, legacy_peak, fused_peak, legacy_time/fused_time))
+
+def bench_scaling(cases, threads, repeat):
+    # Packed kernel time against the number of synthesis threads
+    print('%-22s %8s %12s %8s' % ('grid', 'threads', 'time [ms]', 'speedup'))
+    for name, (sm, est_tpc, all_meanVV, dry_meanVV, dry_stdVV, zscore_threshold) in cases:
+        assets = RegionAssets(None, None, None, np.moveaxis(sm, -1, 0), all_meanVV, dry_meanVV, dry_stdVV)
+        del sm
+        n_pixel = len(assets.index)
+        out = (np.empty(n_pixel, dtype=assets.modes.dtype), np.empty(n_pixel, dtype=assets.modes.dtype), np.empty(n_pixel, dtype='uint8'))
+        reference = None
+        for n_threads in threads:
+            best = np.inf
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                synthesis_kernel(assets.modes, est_tpc, assets.all_meanVV, assets.dry_meanVV, assets.dry_stdVV, zscore_threshold, out=out, n_threads=n_threads)
+                best = min(best, time.perf_counter() - t0)
+            if reference is None:
+                reference, base_time = out[2].copy(), best
+            assert np.array_equal(reference, out[2]), 'inundation maps differ for %s with %d threads' % (name, n_threads)
+            print('%-22s %8d %12.1f %7.2fx' % (name, n_threads, best*1e3, base_time/best))
+
+def kernel_cases(region, sizes, dtype='float64'):
+    cases = []
+    if os.path.exists(asset_path(region, 'RSM', 'RSM_hydro.nc')):
+        cases.append((region, region_inputs(region)))
+    else:
+        print('RSM_hydro.nc of %s not found, skipping the region grid' % region)
+    for size in sizes:
+        cases.append(('synthetic %dx%d' % (size, size), synthetic_inputs(size, size, dtype=dtype)))
+    return cases
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FIER synthesis benchmarks')
+    parser.add_argument('bench', choices=['kernel', 'scaling'])
+    parser.add_argument('--region', default='LowerMekong')
+    parser.add_argument('--sizes', type=int, nargs='*', default=None, help='synthetic grid sizes (default 2000 5000, 10000 for scaling)')
+    parser.add_argument('--threads', type=int, nargs='*', default=None, help='thread counts for scaling (default 1, 2, 4, ... up to the core count; capped at FIER_THREADS)')
+    parser.add_argument('--dtype', default='float64')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.bench == 'kernel':
+        bench_kernel(kernel_cases(args.region, args.sizes or [2000, 5000], args.dtype), args.repeat)
+    elif args.bench == 'scaling':
+        threads = args.threads or sorted({min(2**k, os.cpu_count()) for k in range(int(np.log2(os.cpu_count())) + 2)})
+        bench_scaling(kernel_cases(args.region, args.sizes or [10000], args.dtype), threads, args.repeat)
@@ -83,7 +83,7 @@ def generate_depth(flood):
     return costDepthFilter
 
 if 'AOI_str' not in st.session_state:
-    st.session_state.AOI_str = 'LowerMekong'
+    st.session_state.AOI_str = regions()[0]
 
 @st.cache(ttl = 3600)
 def get_wl(mode):
@@ -138,6 +138,12 @@ flood_color = {0: (0.75, 0.75, 0.75, 0.05),
 
 # Page Configuration
 st.set_page_config(layout="wide")
+
+# Pick up replaced AOI assets and models without restarting the app
+start_watcher()
+
+# Zoom of the result maps; the asset level is picked to match it
+map_zoom = 7
 st.title("Forecasting Inundation Extents using REOF Analysis (FIER)-Mekong")
 
 json_data = st.secrets["json_data"]
@@ -149,8 +155,8 @@ row1_col1, row1_col2 = st.columns([2, 1])
 # Set up Geemap
 with row1_col1:
     m = geemap.Map(
-    zoom=7,
-    center=(12.02 , 104.81),
+    zoom=map_zoom,
+    center=region_info(st.session_state.AOI_str).center,
     tiles=None,
     basemap = None
     )
@@ -163,7 +169,7 @@ with row1_col2:
     curr_region = st.session_state.AOI_str
     st.header('Select Date')
     st.subheader('**AOI: %s**'%(curr_region))
-    run_type = st.radio('**Run type**:', ('Hindcast', 'Forecast'))
+    run_type = st.radio('**Run type**:', ('Hindcast', 'Forecast', 'What-if'))
 
     if run_type == 'Hindcast':
         with st.form("Run Hindcasted FIER"):
@@ -192,10 +198,10 @@ with row1_col2:
                     d = pd.Timestamp(date)
                     water_level[site] = round(df[df['time'] == d].water_level.values[0], 3)
 
-                location = [12.23, 104.79] # NEED FIX!!!!!!!!!!!
+                location = region_info(curr_region).center
                 m = geemap.Map(
-                zoom=7,
-                center=(12.23, 104.79),
+                zoom=map_zoom,
+                center=location,
                 tiles=None,
                 basemap = None
                 )
@@ -203,10 +209,10 @@ with row1_col2:
                 basemaps['Google Terrain'].add_to(m)
                 basemaps['Google Satellite Hybrid'].add_to(m)
 
-                image_folder = image_output(curr_region, water_level)
+                image_folder = image_output(curr_region, water_level, session_synthesizer(curr_region, pick_resolution(curr_region, zoom=map_zoom)), requested = ('inundation',))
                 with xr.open_dataset(image_folder +'/output.nc', engine="h5netcdf") as output:
                     bounds = [[output.lat.values.min(), output.lon.values.min()], [output.lat.values.max(), output.lon.values.max()]]
-                    sar_image, z_score_image, water_map_image = output['Synthesized SAR Image'].values, output['Z-score Image'].values, output['Inundation Map'].values
+                    water_map_image = output['Inundation Map'].values
                 
                 innudation_img = gm.netcdf_to_ee(image_folder +'/output.nc',  var_names = 'Inundation Map')
                 innudation_img = innudation_img.clip(ee.Image('users/sondo/output_test').geometry())
@@ -273,7 +279,7 @@ with row1_col2:
             except:
                 pass
 
-    else:
+    elif run_type == 'Forecast':
         with st.form("Run Forecast FIER"):
             sheet_link = pd.read_csv('AOI/%s/wl_sheet.txt'%(str(curr_region)), sep = '\t')
             forecast_wl = get_wl("Forecast")
@@ -299,10 +305,10 @@ with row1_col2:
                     d = pd.Timestamp(date)
                     water_level[site] = round(df[df['time'] == d].water_level.values[0], 3)
 
-                location = [12.23, 104.79] # NEED FIX!!!!!!!!!!!
+                location = region_info(curr_region).center
                 m = geemap.Map(
-                zoom=7,
-                center=(12.23, 104.79),
+                zoom=map_zoom,
+                center=location,
                 tiles=None,
                 basemap = None
                 )
@@ -310,10 +316,10 @@ with row1_col2:
                 basemaps['Google Terrain'].add_to(m)
                 basemaps['Google Satellite Hybrid'].add_to(m)
 
-                image_folder = image_output(curr_region, water_level)
+                image_folder = image_output(curr_region, water_level, session_synthesizer(curr_region, pick_resolution(curr_region, zoom=map_zoom)), requested = ('inundation',))
                 with xr.open_dataset(image_folder +'/output.nc', engine="h5netcdf") as output:
                     bounds = [[output.lat.values.min(), output.lon.values.min()], [output.lat.values.max(), output.lon.values.max()]]
-                    sar_image, z_score_image, water_map_image = output['Synthesized SAR Image'].values, output['Z-score Image'].values, output['Inundation Map'].values
+                    water_map_image = output['Inundation Map'].values
 
                 innudation_img = gm.netcdf_to_ee(image_folder +'/output.nc',  var_names = 'Inundation Map')
                 innudation_img = innudation_img.clip(ee.Image('users/sondo/output_test').geometry())
@@ -380,6 +386,27 @@ with row1_col2:
             except:
                 pass
 
+    else:
+        # Sliders rerun the app on every change; the overlay comes from the
+        # session's incremental synthesizer without writing any files
+        st.markdown('Drag the gauge water levels to explore the inundation extent.')
+        hydrosite = pd.read_csv('AOI/%s/hydrosite.csv'%(str(curr_region)))
+        wl_range = gauge_ranges(curr_region)
+        water_level = {}
+        for i in range(hydrosite.shape[0]):
+            site = hydrosite.loc[i,'ID']
+            low, high, value = wl_range[site]
+            water_level[site] = st.slider('%s (%s) water level [m]'%(hydrosite.loc[i,'Name'], site),
+                min_value = low, max_value = high, value = value, step = 0.01)
+
+        overlay, bounds = whatif_overlay(curr_region, water_level, session_synthesizer(curr_region, pick_resolution(curr_region, zoom=map_zoom)))
+        folium.raster_layers.ImageOverlay(
+            image = overlay,
+            bounds = bounds,
+            name = 'Inundation Map_' + curr_region ,
+            show = True
+        ).add_to(m)
+
     first = Image.open("logo/first.PNG")
     second = Image.open("logo/second_row.PNG")
     st.image([first], width=450,)
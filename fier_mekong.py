@@ -83,6 +83,12 @@ def generate_depth(flood):
 # Page Configuration
 # st.set_page_config(layout="wide")
 
+# Pick up replaced AOI assets and models without restarting the app
+start_watcher()
+
+# Zoom of the result maps; the asset level is picked to match it
+map_zoom = 7
+
 if 'AOI_str' not in st.session_state:
     st.session_state.AOI_str = None
 
@@ -143,11 +149,11 @@ def app():
             m.addLayerControl()
         else:
             curr_region = st.session_state.AOI_str
-            location = (12.23, 104.79) # NEED FIX!!!!!!!!!!!
+            location = region_info(curr_region).center
 
             m = geemap.Map(
-            zoom=7,
-            center=(12.23, 104.79),
+            zoom=map_zoom,
+            center=location,
             tiles=None,
             basemap = None
             )
@@ -169,7 +175,7 @@ def app():
 
             region = st.selectbox(
          'Determine region:',
-         ('LowerMekong',),
+         tuple(regions()),
          )
 
 
@@ -178,10 +184,10 @@ def app():
             if submitted:
                 st.session_state.AOI_str = region
                 curr_region = st.session_state.AOI_str
-                location = [12.23, 104.79] # NEED FIX!!!!!!!!!!!
+                location = region_info(curr_region).center
                 m = geemap.Map(
-                zoom=7,
-                center=(12.23, 104.79),
+                zoom=map_zoom,
+                center=location,
                 tiles=None,
                 basemap = None
                 )
@@ -204,7 +210,7 @@ def app():
         if st.session_state.AOI_str != None:
             st.subheader('Select Date')
             st.markdown('**AOI: %s**'%(curr_region))
-            run_type = st.radio('Run type:', ('Hindcast', 'Forecast'))
+            run_type = st.radio('Run type:', ('Hindcast', 'Forecast', 'What-if'))
             depth = st.checkbox('Flood Depth Estimation')
             curr_region = st.session_state.AOI_str
 
@@ -226,10 +232,10 @@ def app():
                             d = pd.Timestamp(date)
                             water_level[site] = round(df[df['time'] == d].water_level.values[0], 3)
 
-                        location = [12.23, 104.79] # NEED FIX!!!!!!!!!!!
+                        location = region_info(curr_region).center
                         m = geemap.Map(
-                        zoom=7,
-                        center=(12.23, 104.79),
+                        zoom=map_zoom,
+                        center=location,
                         tiles=None,
                         basemap = None
                         )
@@ -237,10 +243,10 @@ def app():
                         basemaps['Google Terrain'].add_to(m)
                         basemaps['Google Satellite Hybrid'].add_to(m)
 
-                        image_folder = image_output(curr_region, water_level)
+                        image_folder = image_output(curr_region, water_level, session_synthesizer(curr_region, pick_resolution(curr_region, zoom=map_zoom)), requested = ('inundation',))
                         # with xr.open_dataset(image_folder +'/output.nc',) as output:
                             # bounds = [[output.lat.values.min(), output.lon.values.min()], [output.lat.values.max(), output.lon.values.max()]]
-                            # sar_image, z_score_image, water_map_image = output['Synthesized SAR Image'].values, output['Z-score Image'].values, output['Inundation Map'].values
+                            # water_map_image = output['Inundation Map'].values
 
                         innudation_img = gm.netcdf_to_ee(image_folder +'/output.nc',  var_names = 'Inundation Map')
                         innudation_img = innudation_img .clip(ee.Image('users/sondo/output_test').geometry())
@@ -289,7 +295,7 @@ def app():
                     except:
                         pass
 
-            else:
+            elif run_type == 'Forecast':
                 with st.form("Run Forecast FIER"):
                     sheet_link = pd.read_csv('AOI/%s/wl_sheet.txt'%(str(curr_region)), sep = '\t')
                     forecast_wl = {}
@@ -324,10 +330,10 @@ def app():
                             d = pd.Timestamp(date)
                             water_level[site] = round(df[df['time'] == d].water_level.values[0], 3)
 
-                        location = [12.23, 104.79] # NEED FIX!!!!!!!!!!!
+                        location = region_info(curr_region).center
                         m = geemap.Map(
-                        zoom=7,
-                        center=(12.23, 104.79),
+                        zoom=map_zoom,
+                        center=location,
                         tiles=None,
                         basemap = None
                         )
@@ -335,10 +341,10 @@ def app():
                         basemaps['Google Terrain'].add_to(m)
                         basemaps['Google Satellite Hybrid'].add_to(m)
 
-                        image_folder = image_output(curr_region, water_level)
+                        image_folder = image_output(curr_region, water_level, session_synthesizer(curr_region, pick_resolution(curr_region, zoom=map_zoom)), requested = ('inundation',))
                         # with xr.open_dataset(image_folder +'/output.nc',) as output:
                             # bounds = [[output.lat.values.min(), output.lon.values.min()], [output.lat.values.max(), output.lon.values.max()]]
-                            # sar_image, z_score_image, water_map_image = output['Synthesized SAR Image'].values, output['Z-score Image'].values, output['Inundation Map'].values
+                            # water_map_image = output['Inundation Map'].values
 
                         innudation_img = gm.netcdf_to_ee(image_folder +'/output.nc',  var_names = 'Inundation Map')
                         innudation_img = innudation_img .clip(ee.Image('users/sondo/output_test').geometry())
@@ -387,6 +393,26 @@ def app():
                     except:
                         pass
 
+            else:
+                # Sliders rerun the app on every change; the overlay comes from
+                # the session's incremental synthesizer without writing files
+                hydrosite = pd.read_csv('AOI/%s/hydrosite.csv'%(str(curr_region)))
+                wl_range = gauge_ranges(curr_region)
+                water_level = {}
+                for i in range(hydrosite.shape[0]):
+                    site = hydrosite.loc[i,'ID']
+                    low, high, value = wl_range[site]
+                    water_level[site] = st.slider('%s (%s) water level [m]'%(hydrosite.loc[i,'Name'], site),
+                        min_value = low, max_value = high, value = value, step = 0.01)
+
+                overlay, bounds = whatif_overlay(curr_region, water_level, session_synthesizer(curr_region, pick_resolution(curr_region, zoom=map_zoom)))
+                folium.raster_layers.ImageOverlay(
+                    image = overlay,
+                    bounds = bounds,
+                    name = 'Inundation Map_' + curr_region ,
+                    show = True
+                ).add_to(m)
+
         first = Image.open("logo/first.PNG")
         second = Image.open("logo/second_row.PNG")
         st.image([first], width=450,)
@@ -1,109 +1,2017 @@
 import os
+import glob
+import importlib.util
+import threading
+import concurrent.futures
+import io
+import json
+import base64
+import copy
+import collections
+import hashlib
+import tempfile
+import argparse
+import atexit
+import warnings
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-from tensorflow.keras import models
-import tensorflow as tf
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 import h5py
+import h5netcdf
 import numpy as np
 import matplotlib.colors
+import matplotlib.path
 import pandas as pd
 import joblib
 import streamlit as st
 import xarray as xr
+import scipy.special
 import matplotlib.pyplot as plt
+from PIL import Image
 #from netCDF4 import Dataset
 
 root_output_folder = 'AOI/'
 
-def tpc_predict(region, site, mode, value):
-    tpc_mode = '%s/TF_model/500m/site-%s_tpc%s.h5'%(str(region), str(site), str(mode).zfill(2))
-    in_model = models.load_model(root_output_folder + tpc_mode)
+# Every region keeps a pyramid of asset levels,
+# AOI/<region>/{RSM,TF_model,stats_img}/<resolution>/, e.g. 500m, 250m, 100m
+# and 30m. A resolution of None means default_resolution for the whole
+# AOI and the level pick_resolution chooses for a bbox or polygon.
+default_resolution = os.environ.get('FIER_RESOLUTION', '500m')
+
+def asset_path(region, kind, name, resolution=None):
+    return root_output_folder + '%s/%s/%s/%s'%(str(region), kind, resolution or default_resolution, name)
+
+# TPC inference backend: 'numpy' evaluates the Dense weights read from the
+# .h5 files without importing TensorFlow, 'keras' loads the full Keras model
+# and 'table' interpolates the tables written by build_tpc_tables.
+tpc_backend = os.environ.get('FIER_TPC_BACKEND', 'numpy')
+
+def _load_keras_model(path):
+    import tensorflow as tf
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    from tensorflow.keras import models
+    return models.load_model(path)
+
+_activations = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1/(1+np.exp(-x)),
+    'softplus': lambda x: np.logaddexp(0, x),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(x)),
+    'swish': lambda x: x/(1+np.exp(-x)),
+}
+
+class NumpyTPCModel:
+    # Forward pass of a Sequential Normalization + Dense TPC model in NumPy,
+    # with the same predict_on_batch interface as the Keras model.
+
+    def __init__(self, path):
+        self.layers = []
+        with h5py.File(path, 'r') as f:
+            config = json.loads(f.attrs['model_config'])
+            model_weights = f['model_weights']
+            for layer in config['config']['layers']:
+                class_name, layer_config = layer['class_name'], layer['config']
+                if class_name in ('InputLayer', 'Dropout'):
+                    continue
+                group = model_weights[layer_config['name']]
+                weights = {}
+                for weight_name in group.attrs['weight_names']:
+                    weight_name = weight_name.decode() if isinstance(weight_name, bytes) else weight_name
+                    weights[weight_name.split('/')[-1].split(':')[0]] = group[weight_name][()].astype('float32')
+
+                if class_name == 'Normalization' and not layer_config.get('invert', False):
+                    # Keras: (x - mean) / maximum(sqrt(variance), epsilon)
+                    scale = np.maximum(np.sqrt(weights['variance']), np.float32(1e-7))
+                    self.layers.append(('normalization', weights['mean'], scale))
+                elif class_name == 'Dense' and layer_config['activation'] in _activations:
+                    bias = weights['bias'] if layer_config.get('use_bias', True) else np.zeros(layer_config['units'], dtype='float32')
+                    self.layers.append(('dense', weights['kernel'], bias, _activations[layer_config['activation']]))
+                else:
+                    raise NotImplementedError('Unsupported layer %s in %s'%(class_name, path))
+
+    def value_range(self, n_std=4):
+        # Plausible water levels from the training statistics of the Normalization layer
+        for layer in self.layers:
+            if layer[0] == 'normalization':
+                return float(layer[1][0] - n_std*layer[2][0]), float(layer[1][0] + n_std*layer[2][0])
+        raise ValueError('Model has no Normalization layer')
+
+    def predict_on_batch(self, x):
+        x = np.array(x, dtype='float32').reshape(-1, 1)
+        for layer in self.layers:
+            if layer[0] == 'normalization':
+                x = (x - layer[1])/layer[2]
+            else:
+                x = layer[3](x @ layer[1] + layer[2])
+        return x
+
+# Process-wide TPC model registry: {(path, backend): (stamp, model)}. Module
+# globals are shared by every Streamlit session and batch job in this process.
+_tpc_registry = {}
+_tpc_registry_lock = threading.Lock()
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def tpc_model_path(region, site, mode, resolution=None):
+    tpc_mode = 'site-%s_tpc%s.h5'%(str(site), str(mode).zfill(2))
+    return os.path.abspath(asset_path(region, 'TF_model', tpc_mode, resolution))
+
+def _tpc_model_files(region, resolution=None):
+    # [(mode, site, path)] for every site-*_tpcNN.h5 model of a region
+    model_files = []
+    for path in sorted(glob.glob(asset_path(region, 'TF_model', 'site-*_tpc*.h5', resolution))):
+        site, mode = os.path.basename(path)[len('site-'):-len('.h5')].rsplit('_tpc', 1)
+        model_files.append((int(mode), site, os.path.abspath(path)))
+    return model_files
+
+def _read_tpc_model(path, backend):
+    if backend == 'keras':
+        return _load_keras_model(path)
+    elif backend == 'numpy':
+        return NumpyTPCModel(path)
+    raise ValueError('Unknown TPC backend: %s'%(backend))
+
+def get_tpc_model(region, site, mode, backend=None, resolution=None):
+    backend = backend or tpc_backend
+    path = tpc_model_path(region, site, mode, resolution)
+    entry = _tpc_registry.get((path, backend))
+    if entry is not None and _watching():
+        return entry[1]
+    stamp = _file_stamp(path)
+    with _tpc_registry_lock:
+        entry = _tpc_registry.get((path, backend))
+        if entry is None or entry[0] != stamp:
+            # Reload only when the .h5 file was replaced on disk
+            entry = (stamp, _read_tpc_model(path, backend))
+            _tpc_registry[(path, backend)] = entry
+    return entry[1]
+
+def load_tpc_models(region, backend=None, resolution=None):
+    # Warm the registry with every TPC model of a region
+    return {mode: get_tpc_model(region, site, mode, backend, resolution) for mode, site, path in _tpc_model_files(region, resolution)}
+
+def check_tpc_parity(region, n_sample=1000, atol=1e-4, resolution=None):
+    # Compare the NumPy backend against the Keras models over each model's
+    # plausible water-level range; needs TensorFlow.
+    report = []
+    for mode, site, path in _tpc_model_files(region, resolution):
+        numpy_model = get_tpc_model(region, site, mode, 'numpy', resolution)
+        keras_model = get_tpc_model(region, site, mode, 'keras', resolution)
+        values = np.linspace(*numpy_model.value_range(), n_sample, dtype='float32').reshape(-1, 1)
+        diff = np.abs(numpy_model.predict_on_batch(values) - np.asarray(keras_model.predict_on_batch(values)))
+        report.append({'mode': mode, 'site': site, 'max_abs_diff': float(diff.max())})
+    report = pd.DataFrame(report)
+    report['ok'] = report.max_abs_diff <= atol
+    return report
+
+def tpc_predict(region, site, mode, value, resolution=None):
+    in_model = get_tpc_model(region, site, mode, resolution=resolution)
     
-    return in_model.predict([value])[0][0]
+    return in_model.predict_on_batch(np.array([[value]], dtype='float32'))[0][0]
     #print('t',value)
     #return in_model.predict(np.array(value))[0][0]
 
-def synthesize_sar(region, water_level,):
-    
-    sm_mode = '%s/RSM/500m/RSM_hydro.nc'%(region)
-    #st.write(str(root_output_folder + sm_mode))
+def tpc_predict_batch(region, site, mode, values, backend=None, resolution=None):
+    in_model = get_tpc_model(region, site, mode, backend, resolution)
+    values = np.asarray(values, dtype='float32').reshape(-1, 1)
 
-    #st.write(os.listdir('/home/adminuser/venv/lib/python3.9/site-packages/geemap'))
-    #d = h5py.File(root_output_folder + sm_mode, 'r')
-    #st.write(str(d.keys()))
-    #d.close
-    
-    RSM = xr.open_dataset(root_output_folder + sm_mode, engine="h5netcdf")
-    df_cv_results= pd.read_excel(root_output_folder + '%s/TF_model/500m/'%(str(region)) + 'GridsearchCV_results.xlsx', index_col=0)
-
-    water_level_list = []
-    est_tpc_list = []
-    for ct_mode in range(len(RSM.mode.values)):
-
-        sm = RSM.spatial_modes.values[:,:,ct_mode]
-
-        site = str(RSM.hydro_site.sel(mode = ct_mode + 1).values)
-        mode = ct_mode + 1
-        value = float(water_level[site])
-        water_level_list.append(value)
-
-        
-        
-        est_tpc = tpc_predict(region, site, ct_mode + 1, value)*df_cv_results.RTPC_std[ct_mode]+df_cv_results.RTPC_mean[ct_mode]
-        est_tpc_list.append(est_tpc)
-        if ct_mode == 0:
-            syn_sar = sm*est_tpc
+    return np.asarray(in_model.predict_on_batch(values))[:,0]
+
+# Tabulated TPC models: every model sampled over its plausible water-level
+# range with the RTPC_std/RTPC_mean de-standardization baked in. The step is
+# in units of each gauge's training std and the error in units of RTPC_std;
+# tables whose interpolation error exceeds tpc_table_max_error are not served.
+tpc_table_step = 1e-4
+tpc_table_max_error = 1e-4
+_tpc_tables = {}
+_tpc_tables_lock = threading.Lock()
+
+class TPCTable:
+
+    def __init__(self, region, site, mode, water_levels, tpcs, max_error, rtpc_std, rtpc_mean, resolution=None):
+        self.region, self.site, self.mode = region, site, mode
+        self.resolution = resolution
+        self.water_levels, self.tpcs = water_levels, tpcs
+        self.max_error = max_error
+        self.rtpc_std, self.rtpc_mean = rtpc_std, rtpc_mean
+
+    def __call__(self, values):
+        values = np.asarray(values, dtype='float64')
+        est_tpc = np.interp(values, self.water_levels, self.tpcs)
+        # Out-of-table water levels fall back to the model itself
+        outside = (values < self.water_levels[0]) | (values > self.water_levels[-1])
+        if outside.any():
+            est_tpc[outside] = tpc_predict_batch(self.region, self.site, self.mode, values[outside], 'numpy', self.resolution)*self.rtpc_std+self.rtpc_mean
+        return est_tpc
+
+def tpc_table_path(region, resolution=None):
+    return asset_path(region, 'TF_model', 'tpc_tables.npz', resolution)
+
+def build_tpc_tables(region, step=None, n_std=6, reference=None, resolution=None):
+    # Tabulate every TPC model of a region and write tpc_tables.npz. The
+    # maximum deviation from the reference model (Keras when TensorFlow is
+    # installed) is measured at the midpoints between table nodes.
+    step = step or tpc_table_step
+    if reference is None:
+        reference = 'keras' if importlib.util.find_spec('tensorflow') else 'numpy'
+    cv_results_path = asset_path(region, 'TF_model', 'GridsearchCV_results.xlsx', resolution)
+    cv_results_stamp = _file_stamp(cv_results_path)
+    df_cv_results= pd.read_excel(cv_results_path, index_col=0)
+
+    # The RTPC_std/RTPC_mean of the xlsx are baked into the tables
+    arrays = {'cv_results_stamp': np.array(cv_results_stamp)}
+    report = []
+    for mode, site, path in _tpc_model_files(region, resolution):
+        rtpc_std, rtpc_mean = df_cv_results.RTPC_std[mode - 1], df_cv_results.RTPC_mean[mode - 1]
+        lo, hi = get_tpc_model(region, site, mode, 'numpy', resolution).value_range(n_std)
+        water_levels = np.linspace(lo, hi, int(round(2*n_std/step)) + 1)
+        tpcs = tpc_predict_batch(region, site, mode, water_levels, reference, resolution)*rtpc_std+rtpc_mean
+
+        midpoints = (water_levels[:-1] + water_levels[1:])/2
+        expected = tpc_predict_batch(region, site, mode, midpoints, reference, resolution)*rtpc_std+rtpc_mean
+        max_error = float(np.abs(np.interp(midpoints, water_levels, tpcs) - expected).max()/rtpc_std)
+
+        key = 'tpc%s'%(str(mode).zfill(2))
+        arrays[key + '_water_level'] = water_levels
+        arrays[key + '_tpc'] = tpcs
+        arrays[key + '_meta'] = np.array([max_error, rtpc_std, rtpc_mean])
+        arrays[key + '_site'] = np.array(site)
+        arrays[key + '_stamp'] = np.array(_file_stamp(path))
+        report.append({'mode': mode, 'site': site, 'n_nodes': len(water_levels), 'min_water_level': lo, 'max_water_level': hi, 'max_error': max_error})
+
+    np.savez(tpc_table_path(region, resolution), **arrays)
+    report = pd.DataFrame(report)
+    report['ok'] = report.max_error <= tpc_table_max_error
+    return report
+
+def _read_tpc_tables(region, model_files, resolution=None):
+    path = tpc_table_path(region, resolution)
+    if not os.path.exists(path):
+        return None
+    tables = {}
+    with np.load(path) as arrays:
+        cv_results_path = asset_path(region, 'TF_model', 'GridsearchCV_results.xlsx', resolution)
+        if 'cv_results_stamp' not in arrays or tuple(arrays['cv_results_stamp']) != _file_stamp(cv_results_path):
+            # Built with older de-standardization statistics
+            return None
+        for mode, site, model_path in model_files:
+            key = 'tpc%s'%(str(mode).zfill(2))
+            if key + '_stamp' not in arrays or tuple(arrays[key + '_stamp']) != _file_stamp(model_path):
+                # Built from an older version of the model
+                return None
+            max_error, rtpc_std, rtpc_mean = arrays[key + '_meta']
+            tables[mode] = TPCTable(region, site, mode, arrays[key + '_water_level'], arrays[key + '_tpc'], max_error, rtpc_std, rtpc_mean, resolution)
+    return tables
+
+def _tpc_tables_stamp(region, resolution):
+    model_files = _tpc_model_files(region, resolution)
+    cv_results_path = asset_path(region, 'TF_model', 'GridsearchCV_results.xlsx', resolution)
+    return model_files, tuple(_file_stamp(model_path) for mode, site, model_path in model_files) + (_file_stamp(cv_results_path),)
+
+def _build_tpc_tables(region, resolution, model_files):
+    tables = _read_tpc_tables(region, model_files, resolution)
+    if tables is None:
+        build_tpc_tables(region, resolution=resolution)
+        tables = _read_tpc_tables(region, model_files, resolution)
+    return tables
+
+def load_tpc_tables(region, resolution=None):
+    # {mode: TPCTable}; (re)builds tpc_tables.npz when missing or stale
+    resolution = resolution or default_resolution
+    entry = _tpc_tables.get((region, resolution))
+    if entry is None or not _watching():
+        model_files, stamp = _tpc_tables_stamp(region, resolution)
+        with _tpc_tables_lock:
+            entry = _tpc_tables.get((region, resolution))
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, _build_tpc_tables(region, resolution, model_files))
+                _tpc_tables[(region, resolution)] = entry
+
+    for table in entry[1].values():
+        if table.max_error > tpc_table_max_error:
+            raise ValueError('TPC table for %s mode %d deviates by %.3g from its model (limit %.3g); rebuild it with a finer step'%(table.site, table.mode, table.max_error, tpc_table_max_error))
+    return entry[1]
+
+def estimate_tpc(region, site, mode, values, df_cv_results, backend=None, resolution=None):
+    # De-standardized TPCs of one mode for an array of water levels
+    backend = backend or tpc_backend
+    if backend == 'table':
+        return load_tpc_tables(region, resolution)[mode](values)
+    return tpc_predict_batch(region, site, mode, values, backend, resolution)*df_cv_results.RTPC_std[mode - 1]+df_cv_results.RTPC_mean[mode - 1]
+
+def tpc_version(region, sites, backend=None, resolution=None):
+    # Stamps of the TPC models (or tables) estimate_tpc currently uses for
+    # the sites in mode order; changes whenever one of them is reloaded
+    backend = backend or tpc_backend
+    resolution = resolution or default_resolution
+    if backend == 'table':
+        load_tpc_tables(region, resolution)
+        return _tpc_tables[(region, resolution)][0]
+    version = []
+    for ct_mode, site in enumerate(sites):
+        get_tpc_model(region, site, ct_mode + 1, backend, resolution)
+        version.append(_tpc_registry[(tpc_model_path(region, site, ct_mode + 1, resolution), backend)][0])
+    return tuple(version)
+
+def _read_stats_img(region, name, window={}, resolution=None):
+    with xr.open_dataset(asset_path(region, 'stats_img', '%s.nc'%(name), resolution), engine="h5netcdf") as stats_img:
+        return stats_img.isel(window).to_array().values[0,:,:]
+
+def _region_files(region, resolution=None):
+    return [asset_path(region, 'RSM', 'RSM_hydro.nc', resolution),
+            asset_path(region, 'TF_model', 'GridsearchCV_results.xlsx', resolution)] + \
+           [asset_path(region, 'stats_img', '%s.nc'%(name), resolution) for name in ('all_meanVV', 'dry_meanVV', 'dry_stdVV')]
+
+# Quantized asset encodings: 'float16', or 'int16' with a scale and offset
+# per statistics image and per spatial mode. Encoded arrays stay encoded in
+# memory, on disk and in shared memory; the kernels decode them block by
+# block to quantized_compute_dtype. See validate_encoding for their accuracy.
+encodings = ('float16', 'int16')
+quantized_compute_dtype = 'float32'
+_int16_nan = -32768
+
+def _float_dtype(dtype):
+    # Float type of the products for a dtype or an asset encoding
+    dtype = np.dtype(dtype)
+    return np.dtype(quantized_compute_dtype) if dtype.name in encodings else dtype
+
+def _quantize(array, kind):
+    # (encoded array, scale, offset, has_nan); 2-D arrays get one scale and
+    # offset per row
+    has_nan = bool(np.isnan(array).any())
+    if kind == 'float16':
+        ones = np.ones(array.shape[0]) if array.ndim == 2 else 1.0
+        return array.astype('float16'), ones, ones*0, has_nan
+    axis = -1 if array.ndim == 2 else None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanmin(array, axis=axis), np.nanmax(array, axis=axis)
+    low, high = np.nan_to_num(low), np.nan_to_num(high)
+    scale = np.maximum(high - low, np.finfo('float64').tiny)/65532
+    offset = (high + low)/2
+    if array.ndim == 2:
+        encoded = np.rint((array - offset[:, None])/scale[:, None])
+    else:
+        encoded = np.rint((array - offset)/scale)
+    encoded = np.where(np.isnan(array), _int16_nan, encoded).astype('int16')
+    return encoded, scale, offset, has_nan
+
+def _decode(array, scale, offset, has_nan, out=None):
+    # Decoded float copy of an encoded (block of an) array
+    if out is None:
+        out = np.empty(array.shape, dtype=quantized_compute_dtype)
+    if np.ndim(scale):
+        np.multiply(array, np.asarray(scale)[:, None], out=out, dtype=out.dtype)
+        out += np.asarray(offset)[:, None]
+    else:
+        np.multiply(array, scale, out=out, dtype=out.dtype)
+        out += offset
+    if has_nan:
+        out[array == _int16_nan if array.dtype == 'int16' else np.isnan(array)] = np.nan
+    return out
+
+class RegionAssets:
+    # Spatial modes and statistics images of a region packed to the valid
+    # pixels of the AOI (non-NaN dry_meanVV). sm comes in as (mode, lat, lon),
+    # modes is (mode, pixel) and the statistics are 1-D; to_grid scatters
+    # packed results back to the grid. encoding is None for float arrays or
+    # {name: (scale, offset, has_nan)} for quantized ones.
+    encoding = None
+    _decoded = None
+
+    def __init__(self, region, sites, cv_results, sm, all_meanVV, dry_meanVV, dry_stdVV, dims=None, coords=None, resolution=None):
+        self.region = region
+        self.resolution = resolution or default_resolution
+        self.sites = sites
+        self.cv_results = cv_results
+        self.dims, self.coords = dims, coords
+        self.shape = dry_meanVV.shape
+        self.index = np.flatnonzero(~np.isnan(dry_meanVV))
+        self.modes = np.ascontiguousarray(sm.reshape(sm.shape[0], -1)[:, self.index])
+        self.all_meanVV = all_meanVV.reshape(-1)[self.index]
+        self.dry_meanVV = dry_meanVV.reshape(-1)[self.index]
+        self.dry_stdVV = dry_stdVV.reshape(-1)[self.index]
+
+    @classmethod
+    def from_packed(cls, region, sites, cv_results, shape, index, modes, all_meanVV, dry_meanVV, dry_stdVV, dims=None, coords=None, resolution=None, encoding=None):
+        # Assets from already packed arrays, e.g. memory maps of a bundle
+        assets = cls.__new__(cls)
+        assets.encoding = encoding
+        assets.region, assets.sites, assets.cv_results = region, sites, cv_results
+        assets.resolution = resolution or default_resolution
+        assets.dims, assets.coords, assets.shape = dims, coords, tuple(shape)
+        assets.index, assets.modes = index, modes
+        assets.all_meanVV, assets.dry_meanVV, assets.dry_stdVV = all_meanVV, dry_meanVV, dry_stdVV
+        return assets
+
+    def astype(self, dtype):
+        # Float or encoded ('float16', 'int16') copy
+        dtype = np.dtype(dtype).name
+        if dtype in encodings:
+            return self.encode(dtype)
+        source = self.decoded()
+        assets = copy.copy(source)
+        for name in ('modes', 'all_meanVV', 'dry_meanVV', 'dry_stdVV'):
+            setattr(assets, name, getattr(source, name).astype(dtype))
+        return assets
+
+    def encode(self, kind):
+        if kind not in encodings:
+            raise ValueError('Unknown asset encoding: %s'%(kind))
+        source = self.decoded()
+        assets = copy.copy(source)
+        assets.encoding = {}
+        for name in ('modes', 'all_meanVV', 'dry_meanVV', 'dry_stdVV'):
+            encoded, scale, offset, has_nan = _quantize(np.asarray(getattr(source, name), dtype='float64'), kind)
+            if name == 'modes' and has_nan:
+                raise ValueError('Spatial modes of %s have NaNs inside the AOI and cannot be encoded'%(self.region))
+            setattr(assets, name, encoded)
+            assets.encoding[name] = (scale, offset, has_nan)
+        return assets
+
+    def decoded(self):
+        # Float copy of encoded assets (self for float ones) for the code
+        # paths that work on whole arrays rather than on kernel blocks
+        if self.encoding is None:
+            return self
+        if self._decoded is None:
+            assets = copy.copy(self)
+            assets.encoding = None
+            for name in ('modes', 'all_meanVV', 'dry_meanVV', 'dry_stdVV'):
+                setattr(assets, name, _decode(getattr(self, name), *self.encoding[name]))
+            self._decoded = assets
+        return self._decoded
+
+    @property
+    def storage_dtype(self):
+        return self.modes.dtype.name
+
+    @property
+    def float_dtype(self):
+        # dtype of the synthesized products
+        return self.modes.dtype if self.encoding is None else _float_dtype(self.storage_dtype)
+
+    @property
+    def n_mode(self):
+        return self.modes.shape[0]
+
+    @property
+    def nbytes(self):
+        # Size of the packed arrays, including a decoded copy if one is kept
+        size = sum(getattr(self, name).nbytes for name in ('index', 'modes', 'all_meanVV', 'dry_meanVV', 'dry_stdVV'))
+        if self._decoded is not None:
+            size += self._decoded.nbytes - self.index.nbytes
+        return size
+
+    @property
+    def bounds(self):
+        # [[south, west], [north, east]] for map overlays
+        lat, lon = self.coords['lat'].values, self.coords['lon'].values
+        return [[float(lat.min()), float(lon.min())], [float(lat.max()), float(lon.max())]]
+
+    @property
+    def affine(self):
+        # (lat0, dlat, lon0, dlon) of the regular AOI grid, pixel centers
+        lat, lon = self.coords['lat'].values, self.coords['lon'].values
+        return (float(lat[0]), float(lat[-1] - lat[0])/max(len(lat) - 1, 1),
+                float(lon[0]), float(lon[-1] - lon[0])/max(len(lon) - 1, 1))
+
+    def pixel_index(self, lats, lons):
+        # Nearest (rows, cols) of lat/lon points from the grid affine; -1 for
+        # points off the grid
+        lat0, dlat, lon0, dlon = self.affine
+        rows = np.rint((np.asarray(lats, dtype='float64') - lat0)/dlat).astype('int64')
+        cols = np.rint((np.asarray(lons, dtype='float64') - lon0)/dlon).astype('int64')
+        off_grid = (rows < 0) | (rows >= self.shape[0]) | (cols < 0) | (cols >= self.shape[1])
+        rows[off_grid] = -1
+        cols[off_grid] = -1
+        return rows, cols
+
+    def to_grid(self, packed, fill=np.nan):
+        # (..., pixel) -> (..., lat, lon); pixels outside the AOI get fill
+        packed = np.asarray(packed)
+        grid = np.full(packed.shape[:-1] + (self.shape[0]*self.shape[1],), fill, dtype=packed.dtype)
+        grid[..., self.index] = packed
+        return grid.reshape(packed.shape[:-1] + self.shape)
+
+    def crop(self, window, polygon=None):
+        # Assets of a row/column window of the grid, and of the pixels
+        # inside polygon ((lon, lat) vertices), sliced from the packed arrays
+        # without reading anything. The index is sorted, so only the pixels
+        # of the window's rows are looked at.
+        rows, cols = window['lat'], window['lon']
+        n_col = self.shape[1]
+        lo, hi = np.searchsorted(self.index, [rows.start*n_col, rows.stop*n_col])
+        row, col = np.divmod(self.index[lo:hi], n_col)
+        keep = (col >= cols.start) & (col < cols.stop)
+        if polygon is not None:
+            lat, lon = self.coords['lat'].values, self.coords['lon'].values
+            path = matplotlib.path.Path(np.asarray(polygon, dtype='float64'))
+            keep[keep] = path.contains_points(np.column_stack([lon[col[keep]], lat[row[keep]]]))
+        selection = lo + np.flatnonzero(keep)
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        index = (row[keep] - rows.start)*shape[1] + col[keep] - cols.start
+        coords = self.coords.to_dataset().isel(window).coords
+        return RegionAssets.from_packed(self.region, self.sites, self.cv_results, shape, index, self.modes[:, selection],
+                                        self.all_meanVV[selection], self.dry_meanVV[selection], self.dry_stdVV[selection],
+                                        self.dims, coords, self.resolution, self.encoding)
+
+def _window(coords, bbox):
+    # Row/column slices of the grid covering bbox = (south, west, north, east)
+    south, west, north, east = bbox
+    window = {}
+    for name, low, high in (('lat', south, north), ('lon', west, east)):
+        inside = np.flatnonzero((coords[name] >= low) & (coords[name] <= high))
+        if len(inside) == 0:
+            raise ValueError('ROI %s does not overlap the AOI grid'%(str(bbox)))
+        window[name] = slice(int(inside[0]), int(inside[-1]) + 1)
+    return window
+
+def resolution_meters(resolution):
+    # '500m' -> 500.0, '1km' -> 1000.0
+    resolution = resolution or default_resolution
+    if resolution.endswith('km'):
+        return float(resolution[:-2])*1000
+    return float(resolution.rstrip('m'))
+
+def region_resolutions(region):
+    # Asset levels of a region that have spatial modes, coarsest first
+    levels = [os.path.basename(os.path.dirname(path)) for path in glob.glob(asset_path(region, 'RSM', 'RSM_hydro.nc', '*'))]
+    return sorted(levels, key=resolution_meters, reverse=True)
+
+def pick_resolution(region, bbox=None, zoom=None, display_pixels=1024):
+    # Coarsest level of the pyramid that is still at least as fine as the
+    # requested pixel size: the web map ground resolution at zoom, or the
+    # bbox (default: the whole AOI, from the region catalog) spread over
+    # display_pixels pixels
+    levels = region_resolutions(region)
+    if not levels:
+        raise ValueError('No RSM assets found for %s'%(region))
+    if bbox is None:
+        bbox = region_info(region).bbox
+    south, west, north, east = bbox
+    cos_lat = np.cos(np.radians((south + north)/2))
+    if zoom is not None:
+        target = 156543.03392*cos_lat/2**zoom
+    else:
+        target = max(north - south, (east - west)*cos_lat)*111320/display_pixels
+    for level in levels:
+        if resolution_meters(level) <= target:
+            return level
+    return levels[-1]
+
+def _roi_resolution(region, bbox=None, polygon=None, resolution=None):
+    # Level for a request without an explicit resolution: the coarsest one
+    # that still resolves its ROI, or default_resolution for the whole AOI
+    if resolution is None and (bbox is not None or polygon is not None):
+        return pick_resolution(region, bbox if polygon is None else _polygon_bbox(polygon))
+    return resolution
+
+def spatial_modes_path(region, resolution=None):
+    # Named after the _file_stamp of the RSM_hydro.nc it is built from, so a
+    # replaced source gets a new file even when its mtime is older
+    mtime_ns, size = _file_stamp(asset_path(region, 'RSM', 'RSM_hydro.nc', resolution))
+    return asset_path(region, 'RSM', 'spatial_modes-%d-%d.npy'%(mtime_ns, size), resolution)
+
+# {folder: Lock} serializing the spatial modes rebuilds of each level
+_spatial_modes_locks = {}
+_spatial_modes_locks_lock = threading.Lock()
+
+def build_spatial_modes(region, resolution=None):
+    # Rewrites RSM.spatial_modes as a C-contiguous (mode, lat, lon) .npy
+    # file, one mode at a time, so that every mode is one contiguous block.
+    # Written to a unique temporary file and moved into place, so readers
+    # never map a partly written file.
+    path = spatial_modes_path(region, resolution)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        with xr.open_dataset(asset_path(region, 'RSM', 'RSM_hydro.nc', resolution), engine="h5netcdf") as RSM:
+            spatial_modes = RSM.spatial_modes
+            shape = (len(RSM.mode.values), RSM.sizes['lat'], RSM.sizes['lon'])
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=spatial_modes.dtype, shape=shape)
+            for ct_mode in range(shape[0]):
+                out[ct_mode] = spatial_modes.isel(mode = ct_mode).transpose('lat', 'lon').values
+            out.flush()
+            del out
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    # Files built from earlier versions; open memory maps stay valid
+    for old_path in glob.glob(os.path.join(os.path.dirname(path), 'spatial_modes*.npy')):
+        if old_path != path:
+            os.remove(old_path)
+    return path
+
+def open_spatial_modes(region, resolution=None):
+    # Read-only memory map of the (mode, lat, lon) spatial modes: sm[k] is a
+    # contiguous zero-copy view and pages of unused modes or windows are
+    # never read. Rebuilt when RSM_hydro.nc was replaced since.
+    path = spatial_modes_path(region, resolution)
+    if not os.path.exists(path):
+        with _spatial_modes_locks_lock:
+            lock = _spatial_modes_locks.setdefault(os.path.dirname(path), threading.Lock())
+        with lock:
+            # Another thread may have rebuilt it while this one waited
+            if not os.path.exists(path):
+                build_spatial_modes(region, resolution)
+    return np.load(path, mmap_mode='r')
+
+def _polygon_bbox(polygon):
+    polygon = np.asarray(polygon, dtype='float64')
+    return (polygon[:,1].min(), polygon[:,0].min(), polygon[:,1].max(), polygon[:,0].max())
+
+# {(region, resolution): (stamp, (sites, cv_results))} for _read_region,
+# which runs for every ROI request and out-of-core band
+_region_metadata_cache = {}
+
+def _region_metadata(region, resolution=None):
+    # (gauge of every mode, GridsearchCV results) of a level, reread only
+    # when RSM_hydro.nc or the xlsx change
+    resolution = resolution or default_resolution
+    paths = (asset_path(region, 'RSM', 'RSM_hydro.nc', resolution), asset_path(region, 'TF_model', 'GridsearchCV_results.xlsx', resolution))
+    stamp = tuple(_file_stamp(path) for path in paths)
+    entry = _region_metadata_cache.get((region, resolution))
+    if entry is None or entry[0] != stamp:
+        with xr.open_dataset(paths[0], engine="h5netcdf") as RSM:
+            sites = [str(RSM.hydro_site.sel(mode = ct_mode + 1).values) for ct_mode in range(len(RSM.mode.values))]
+        entry = (stamp, (sites, pd.read_excel(paths[1], index_col=0)))
+        _region_metadata_cache[(region, resolution)] = entry
+    return entry[1]
+
+def _read_region(region, bbox=None, polygon=None, resolution=None, window=None):
+    # Reads the region assets; with a bbox or polygon ((lon, lat) vertices)
+    # only the hyperslab covering it is read from every NetCDF variable and
+    # pixels outside the polygon are left out of the packed AOI. An explicit
+    # window of row/column slices overrides the bbox.
+    if polygon is not None:
+        polygon = np.asarray(polygon, dtype='float64')
+        bbox = _polygon_bbox(polygon)
+
+    with xr.open_dataset(asset_path(region, 'stats_img', 'all_meanVV.nc', resolution), engine="h5netcdf") as all_meanVV:
+        if window is None:
+            window = {} if bbox is None else _window({'lat': all_meanVV.lat.values, 'lon': all_meanVV.lon.values}, bbox)
+        all_meanVV = all_meanVV.isel(window)
+        dims, coords = all_meanVV[list(all_meanVV.data_vars)[0]].dims, all_meanVV.coords.to_dataset().load().coords
+        all_meanVV = all_meanVV.to_array().values[0,:,:]
+
+    sites, df_cv_results = _region_metadata(region, resolution)
+    # Only the pages of the window are read from the memory-mapped modes
+    sm = open_spatial_modes(region, resolution)[:, window.get('lat', slice(None)), window.get('lon', slice(None))]
+
+    dry_meanVV = _read_stats_img(region, 'dry_meanVV', window, resolution)
+    dry_stdVV = _read_stats_img(region, 'dry_stdVV', window, resolution)
+    if polygon is not None:
+        lon, lat = np.meshgrid(coords['lon'].values, coords['lat'].values)
+        inside = matplotlib.path.Path(polygon).contains_points(np.column_stack([lon.reshape(-1), lat.reshape(-1)]))
+        dry_meanVV = np.where(inside.reshape(dry_meanVV.shape), dry_meanVV, np.nan)
+
+    return RegionAssets(region, sites, df_cv_results, sm, all_meanVV, dry_meanVV, dry_stdVV, dims, coords, resolution)
+
+def grid_coords(region, resolution=None):
+    # (dims, coords) of a region's grid; only the coordinates are read
+    with xr.open_dataset(asset_path(region, 'stats_img', 'all_meanVV.nc', resolution), engine="h5netcdf") as all_meanVV:
+        return all_meanVV[list(all_meanVV.data_vars)[0]].dims, all_meanVV.coords.to_dataset().load().coords
+
+def grid_window(region, bbox=None, polygon=None, resolution=None):
+    # (dims, coords, window) of the grid part covering bbox or polygon, with
+    # explicit row/column slices for both dimensions
+    dims, coords = grid_coords(region, resolution)
+    if polygon is not None:
+        bbox = _polygon_bbox(polygon)
+    window = {name: slice(0, coords[name].size) for name in ('lat', 'lon')}
+    if bbox is not None:
+        window.update(_window({'lat': coords['lat'].values, 'lon': coords['lon'].values}, bbox))
+    return dims, coords.to_dataset().isel(window).coords, window
+
+# Floating point type of the modes, statistics, synthesis and z-score, or
+# an asset encoding ('float16', 'int16') that keeps the assets quantized.
+# float32 halves memory traffic; see compare_precision for its accuracy.
+compute_dtype = os.environ.get('FIER_DTYPE', 'float64')
+
+# Compiled AOI bundle: the packed RegionAssets arrays back to back in one
+# raw file plus manifest.json with their dtype, shape, offset and sha256, the
+# grid coordinates and affine, the mode -> gauge mapping, the
+# de-standardization table and the stamps of the source files. Loading is a
+# JSON parse and a few read-only memory maps; no NetCDF or Excel reads.
+bundle_format_version = 1
+_bundle_alignment = 64
+
+def bundle_dir(region, resolution=None):
+    return asset_path(region, 'bundle', '', resolution)
+
+def _hash_array(array):
+    return hashlib.sha256(np.ascontiguousarray(array).view('uint8')).hexdigest()
+
+def _packed_arrays(assets):
+    return {'index': assets.index, 'modes': assets.modes, 'all_meanVV': assets.all_meanVV,
+            'dry_meanVV': assets.dry_meanVV, 'dry_stdVV': assets.dry_stdVV,
+            'lat': assets.coords['lat'].values, 'lon': assets.coords['lon'].values}
+
+def _array_layout(arrays, with_hash=True):
+    # ({name: {dtype, shape, offset[, sha256]}}, total bytes) of the arrays
+    # laid out back to back at _bundle_alignment boundaries
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset//_bundle_alignment)*_bundle_alignment
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        if with_hash:
+            entries[name]['sha256'] = _hash_array(array)
+        offset += array.nbytes
+    return entries, offset
+
+def _assets_metadata(assets):
+    # JSON-serializable description of everything but the packed arrays
+    return {
+        'resolution': assets.resolution,
+        'shape': list(assets.shape),
+        'dims': list(assets.dims),
+        'coord_attrs': {name: {key: np.asarray(value).tolist() for key, value in assets.coords[name].attrs.items()} for name in ('lat', 'lon')},
+        'affine': list(assets.affine),
+        'modes': [{'mode': ct_mode + 1, 'site': site} for ct_mode, site in enumerate(assets.sites)],
+        'cv_results': assets.cv_results.to_dict(orient='split'),
+        'encoding': None if assets.encoding is None else
+                    {name: [np.asarray(scale).tolist(), np.asarray(offset).tolist(), has_nan] for name, (scale, offset, has_nan) in assets.encoding.items()},
+    }
+
+def _assets_from_arrays(region, metadata, arrays):
+    coords = xr.Dataset(coords={name: (name, np.asarray(arrays[name]), metadata['coord_attrs'][name]) for name in ('lat', 'lon')}).coords
+    cv_results = pd.DataFrame(**metadata['cv_results'])
+    sites = [entry['site'] for entry in sorted(metadata['modes'], key=lambda entry: entry['mode'])]
+    encoding = metadata.get('encoding')
+    if encoding is not None:
+        encoding = {name: (np.asarray(scale) if isinstance(scale, list) else scale, np.asarray(offset) if isinstance(offset, list) else offset, has_nan)
+                    for name, (scale, offset, has_nan) in encoding.items()}
+    return RegionAssets.from_packed(region, sites, cv_results, metadata['shape'], arrays['index'], arrays['modes'],
+                                    arrays['all_meanVV'], arrays['dry_meanVV'], arrays['dry_stdVV'],
+                                    tuple(metadata['dims']), coords, metadata['resolution'], encoding)
+
+def build_bundle(region, resolution=None, encoding=None):
+    # Compiles the region assets into bundle/<resolution>/ and returns the
+    # manifest; encoding ('float16' or 'int16') quantizes the stored arrays.
+    # The arrays file is named after its content hash and the manifest is
+    # replaced last, so readers never see a partial bundle.
+    resolution = resolution or default_resolution
+    assets = _read_region(region, resolution=resolution)
+    if encoding is not None:
+        assets = assets.encode(encoding)
+    folder = bundle_dir(region, resolution)
+    os.makedirs(folder, exist_ok=True)
+
+    arrays = {name: np.ascontiguousarray(array) for name, array in _packed_arrays(assets).items()}
+    entries, size = _array_layout(arrays)
+    content_hash = hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+    data_file = 'arrays-%s.bin'%(content_hash[:16])
+
+    tmp_path = '%s%s.%d.tmp'%(folder, data_file, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        for name, array in arrays.items():
+            f.seek(entries[name]['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp_path, folder + data_file)
+
+    manifest = {
+        'format_version': bundle_format_version,
+        'region': region,
+        'content_hash': content_hash,
+        'data_file': data_file,
+        'arrays': entries,
+        **_assets_metadata(assets),
+        'sources': {os.path.relpath(path, root_output_folder): list(_file_stamp(path)) for path in _region_files(region, resolution)},
+    }
+    tmp_path = '%smanifest.json.%d.tmp'%(folder, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, default=lambda value: value.item())
+    os.replace(tmp_path, folder + 'manifest.json')
+
+    for path in glob.glob(folder + 'arrays-*.bin'):
+        if os.path.basename(path) != data_file:
+            os.remove(path)
+    return manifest
+
+def read_bundle_manifest(region, resolution=None):
+    # Manifest of an up-to-date bundle, or None when there is no bundle or a
+    # source file changed since it was built. Sources that are not shipped
+    # alongside the bundle are not checked.
+    path = bundle_dir(region, resolution) + 'manifest.json'
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] != bundle_format_version:
+        return None
+    for source, stamp in manifest['sources'].items():
+        source = root_output_folder + source
+        if os.path.exists(source) and list(_file_stamp(source)) != stamp:
+            return None
+    return manifest
+
+def load_bundle(region, resolution=None, manifest=None):
+    # RegionAssets whose arrays are read-only memory maps of the bundle
+    manifest = manifest or read_bundle_manifest(region, resolution)
+    if manifest is None:
+        raise ValueError('No up-to-date bundle for %s at %s; run build_bundle first'%(region, resolution or default_resolution))
+    data_path = bundle_dir(region, manifest['resolution']) + manifest['data_file']
+    arrays = {name: np.memmap(data_path, dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=tuple(entry['shape']))
+              for name, entry in manifest['arrays'].items()}
+    return _assets_from_arrays(region, manifest, arrays)
+
+def verify_bundle(region, resolution=None):
+    # {array name: ok} after re-hashing every array of the bundle
+    manifest = read_bundle_manifest(region, resolution)
+    assets = load_bundle(region, resolution, manifest)
+    return {name: _hash_array(array) == manifest['arrays'][name]['sha256'] for name, array in _packed_arrays(assets).items()}
+
+# Shared-memory assets for hosts running several worker processes: the
+# first process to load a region publishes its packed arrays (in the compute
+# dtype) into a named shared memory block and every other process attaches
+# read-only views instead of loading its own copy. A small header block per
+# (region, resolution, dtype) names the current data block and the source
+# stamp it was built from. Data blocks belong to the publishing process and
+# are unlinked when it exits, together with the header if it still names
+# that block; the next worker to start publishes them again.
+shared_assets = os.environ.get('FIER_SHARED_ASSETS', '0') == '1'
+_shared_blocks = {}
+
+@atexit.register
+def _unlink_shared():
+    for name, (header, block) in _shared_blocks.items():
+        # Another process may have republished the header since
+        if _shared_header_block(name) == block.name:
+            try:
+                header.unlink()
+            except FileNotFoundError:
+                pass
         else:
-            syn_sar = syn_sar + sm*est_tpc
-            
-    all_meanVV_dir = '%s/stats_img/500m/all_meanVV.nc'%(region)
-    all_meanVV = xr.open_dataset(root_output_folder + all_meanVV_dir, engine="h5netcdf")
-    all_meanVV = all_meanVV.to_array().values[0,:,:]
-    
-    syn_sar = syn_sar + all_meanVV
-    
-    # Z-score
-    water_level_list = np.array(water_level_list).reshape(1,-1)
-    loaded_model = joblib.load('h2zscore_svm_model_n3_0_i0.01.sav')
-    zscore_threshold = loaded_model.predict(water_level_list)
-    
-    #zscore_threshold = -3
+            _untrack_shared(header)
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+    _shared_blocks.clear()
+
+def _shared_name(region, resolution, dtype):
+    return 'fier_' + ''.join(char if char.isalnum() else '_' for char in '%s_%s_%s'%(region, resolution, dtype))
+
+def _untrack_shared(block):
+    # Attaching registers the block with this process's resource tracker,
+    # which would unlink it for everyone when this process exits
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(block._name, 'shared_memory')
+
+def _read_shared_header(name):
+    # Metadata in the header block name, or None when there is none
+    from multiprocessing import shared_memory
+    try:
+        header = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return None
+    try:
+        if name not in _shared_blocks:
+            # Headers this process created stay tracked until it unlinks them
+            _untrack_shared(header)
+        return json.loads(bytes(header.buf).rstrip(b'\0'))
+    finally:
+        header.close()
+
+def _shared_header_block(name):
+    try:
+        metadata = _read_shared_header(name)
+    except ValueError:
+        return None
+    return None if metadata is None else metadata['block']
+
+def _write_shared_header(name, encoded):
+    # Replaces the header block name with one holding encoded
+    from multiprocessing import shared_memory
+    try:
+        old_header = shared_memory.SharedMemory(name)
+        old_header.close()
+        old_header.unlink()
+    except FileNotFoundError:
+        pass
+    header = shared_memory.SharedMemory(name, create=True, size=len(encoded))
+    header.buf[:len(encoded)] = encoded
+    return header
+
+def _attach_shared(region, resolution, dtype, stamp):
+    # Read-only RegionAssets on the published block, or None when nothing
+    # (or an outdated version) is published
+    from multiprocessing import shared_memory
+    metadata = _read_shared_header(_shared_name(region, resolution, dtype))
+    if metadata is None or metadata['stamp'] != json.loads(json.dumps(stamp)):
+        return None
+    try:
+        block = shared_memory.SharedMemory(metadata['block'])
+    except FileNotFoundError:
+        return None
+    _untrack_shared(block)
+    arrays = {}
+    for name, entry in metadata['arrays'].items():
+        arrays[name] = np.ndarray(tuple(entry['shape']), dtype=entry['dtype'], buffer=block.buf, offset=entry['offset'])
+        arrays[name].flags.writeable = False
+    assets = _assets_from_arrays(region, metadata, arrays)
+    # The views are only valid while the block stays mapped
+    assets.shared_block = block
+    return assets
+
+def _publish_shared(assets, dtype, stamp):
+    # Copies the packed arrays into a new shared block, points the header at
+    # it and returns assets viewing the shared copy
+    from multiprocessing import shared_memory
+    name = _shared_name(assets.region, assets.resolution, dtype)
+    arrays = _packed_arrays(assets)
+    entries, size = _array_layout(arrays, with_hash=False)
+    stamp = json.loads(json.dumps(stamp))
+    block_name = '%s_%s'%(name, hashlib.sha256(json.dumps(stamp).encode()).hexdigest()[:12])
+    metadata = dict(_assets_metadata(assets), block=block_name, arrays=entries, stamp=stamp)
+    encoded = json.dumps(metadata, default=lambda value: value.item()).encode()
+    try:
+        block = shared_memory.SharedMemory(block_name, create=True, size=max(size, 1))
+    except FileExistsError:
+        # Published by another process, which may have been concurrent or
+        # may have lost its header to a republish; the block's owner still
+        # unlinks the header when it exits, so it is not tracked here
+        shared = _attach_shared(assets.region, assets.resolution, dtype, stamp)
+        if shared is None:
+            header = _write_shared_header(name, encoded)
+            _untrack_shared(header)
+            header.close()
+            shared = _attach_shared(assets.region, assets.resolution, dtype, stamp)
+        return shared or assets
+    for array_name, array in arrays.items():
+        entry = entries[array_name]
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, offset=entry['offset'])[...] = array
+
+    previous = _shared_blocks.pop(name, None)
+    header = _write_shared_header(name, encoded)
+    _shared_blocks[name] = (header, block)
+    if previous is not None:
+        # Attached processes keep their mapping of the replaced block
+        previous[1].unlink()
+
+    shared = {}
+    for array_name, entry in entries.items():
+        shared[array_name] = np.ndarray(tuple(entry['shape']), dtype=entry['dtype'], buffer=block.buf, offset=entry['offset'])
+        shared[array_name].flags.writeable = False
+    shared = _assets_from_arrays(assets.region, json.loads(encoded), shared)
+    shared.shared_block = block
+    return shared
+
+def publish_region(region, dtype=None, resolution=None):
+    # Loads a region and publishes it to shared memory whatever the value of
+    # shared_assets, e.g. from a launcher before starting the workers
+    global shared_assets
+    shared_assets, enabled = True, shared_assets
+    try:
+        return load_region(region, dtype, resolution)
+    finally:
+        shared_assets = enabled
+
+# Process-wide region asset cache in least recently used order:
+# {(region, resolution, dtype): (stamp, RegionAssets)}. Regions load on
+# first use, each under its own lock so a slow load does not hold up the
+# other regions, and the least recently used ones are evicted once the
+# cache exceeds region_memory_budget bytes (FIER_REGION_MEMORY_MB, 0 for
+# no limit). Evicted assets stay valid for whoever still holds them.
+region_memory_budget = int(float(os.environ.get('FIER_REGION_MEMORY_MB', 0))*2**20)
+_region_cache = collections.OrderedDict()
+_region_cache_lock = threading.Lock()
+_region_load_locks = {}
+
+def _cached_region(key):
+    with _region_cache_lock:
+        entry = _region_cache.get(key)
+        if entry is not None:
+            _region_cache.move_to_end(key)
+        return entry
+
+def _evict_regions():
+    # Caller holds _region_cache_lock; the most recent entry always stays
+    if not region_memory_budget:
+        return
+    total = sum(assets.nbytes for stamp, assets in _region_cache.values())
+    while total > region_memory_budget and len(_region_cache) > 1:
+        key, (stamp, assets) = _region_cache.popitem(last=False)
+        total -= assets.nbytes
+
+def _cache_region(key, entry):
+    with _region_cache_lock:
+        _region_cache[key] = entry
+        _region_cache.move_to_end(key)
+        _evict_regions()
+
+def _replace_region(key, entry):
+    # Swap in a rebuilt version without reviving an evicted region
+    with _region_cache_lock:
+        if key in _region_cache:
+            _region_cache[key] = entry
+            _evict_regions()
+
+def _bundle_serves(manifest, dtype):
+    # A float bundle holds the source arrays as they are and serves any
+    # dtype; a quantized one only serves its own encoding, since decoding it
+    # to a float dtype or requantizing it would pass on its rounding
+    return manifest.get('encoding') is None or np.dtype(manifest['arrays']['modes']['dtype']).name == dtype
+
+def _region_stamp(region, resolution, dtype):
+    # (bundle manifest or None, stamp of the version load_region would load)
+    # An up-to-date compiled bundle that can serve dtype is preferred over
+    # the source files
+    manifest = read_bundle_manifest(region, resolution)
+    if manifest is not None and _bundle_serves(manifest, dtype):
+        return manifest, manifest['content_hash']
+    return None, tuple(_file_stamp(path) for path in _region_files(region, resolution))
+
+def _build_region(region, resolution, dtype, manifest, stamp):
+    assets = _attach_shared(region, resolution, dtype, stamp) if shared_assets else None
+    if assets is None:
+        if manifest is not None:
+            assets = load_bundle(region, resolution, manifest)
+        else:
+            assets = _read_region(region, resolution=resolution)
+        if assets.storage_dtype != dtype:
+            assets = assets.astype(dtype)
+        if shared_assets:
+            assets = _publish_shared(assets, dtype, stamp)
+    return assets
+
+def load_region(region, dtype=None, resolution=None):
+    dtype = np.dtype(dtype or compute_dtype).name
+    resolution = resolution or default_resolution
+    key = (region, resolution, dtype)
+    entry = _cached_region(key)
+    if entry is not None and _watching():
+        return entry[1]
+    manifest, stamp = _region_stamp(region, resolution, dtype)
+    if entry is None or entry[0] != stamp:
+        with _region_cache_lock:
+            load_lock = _region_load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            # Another request may have loaded it while this one waited
+            entry = _cached_region(key)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, _build_region(region, resolution, dtype, manifest, stamp))
+                _cache_region(key, entry)
+    return entry[1]
+
+def region_assets(region, dtype=None, bbox=None, polygon=None, resolution=None):
+    # Cached assets of the whole AOI, or the assets of an ROI: sliced from
+    # the whole AOI when that is cached or compiled into a bundle, else
+    # read from the window of the source files
+    if bbox is None and polygon is None:
+        return load_region(region, dtype, resolution)
+    resolution = _roi_resolution(region, bbox, polygon, resolution) or default_resolution
+    dtype = np.dtype(dtype or compute_dtype).name
+    if _cached_region((region, resolution, dtype)) is None:
+        manifest = read_bundle_manifest(region, resolution)
+        whole = manifest is not None and _bundle_serves(manifest, dtype)
+    else:
+        whole = True
+    if whole:
+        assets = load_region(region, dtype, resolution)
+        coords = {name: assets.coords[name].values for name in ('lat', 'lon')}
+        return assets.crop(_window(coords, bbox if polygon is None else _polygon_bbox(polygon)), polygon)
+    assets = _read_region(region, bbox, polygon, resolution)
+    return assets if dtype == assets.storage_dtype else assets.astype(dtype)
+
+# Region catalog: every directory of root_output_folder with a
+# hydrosite.csv is a region. Entries only hold metadata read from small
+# files (gauges, asset levels, grid extent); the assets themselves load
+# through load_region on first use. A region is rescanned when its
+# hydrosite.csv or the asset levels on disk change.
+_catalog = {}
+_catalog_lock = threading.Lock()
+
+class RegionInfo:
+
+    def __init__(self, name):
+        self.name = name
+        self.gauges = pd.read_csv(root_output_folder + '%s/hydrosite.csv'%(name))
+        self.resolutions = region_resolutions(name)
+        # {resolution: asset kinds present, plus 'bundle' for an up-to-date one}
+        self.assets = {}
+        for level in self.resolutions:
+            kinds = [kind for kind in ('RSM', 'TF_model', 'stats_img') if os.path.isdir(os.path.dirname(asset_path(name, kind, '', level)))]
+            if read_bundle_manifest(name, level) is not None:
+                kinds.append('bundle')
+            self.assets[level] = kinds
+        if self.resolutions:
+            dims, coords = grid_coords(name, self.resolutions[0])
+            lat, lon = coords['lat'].values, coords['lon'].values
+        else:
+            lat, lon = self.gauges['Lat'].values, self.gauges['Long'].values
+        self.bbox = (float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max()))
+
+    @property
+    def sites(self):
+        return list(self.gauges['ID'])
+
+    @property
+    def center(self):
+        south, west, north, east = self.bbox
+        return ((south + north)/2, (west + east)/2)
+
+def _catalog_stamp(name):
+    return (_file_stamp(root_output_folder + '%s/hydrosite.csv'%(name)), tuple(region_resolutions(name)))
+
+def region_catalog():
+    # {region: RegionInfo} of all regions under root_output_folder
+    names = sorted(name for name in os.listdir(root_output_folder)
+                   if os.path.isfile(root_output_folder + '%s/hydrosite.csv'%(name)))
+    with _catalog_lock:
+        for name in list(_catalog):
+            if name not in names:
+                del _catalog[name]
+        return {name: _catalog_entry(name) for name in names}
+
+def _catalog_entry(name):
+    # Caller holds _catalog_lock
+    stamp = _catalog_stamp(name)
+    entry = _catalog.get(name)
+    if entry is None or entry[0] != stamp:
+        entry = (stamp, RegionInfo(name))
+        _catalog[name] = entry
+    return entry[1]
+
+def regions():
+    return list(region_catalog())
+
+def region_info(region):
+    # Catalog entry of one region; only that region is rescanned
+    if not os.path.isfile(root_output_folder + '%s/hydrosite.csv'%(region)):
+        raise ValueError('Unknown region: %s'%(region))
+    with _catalog_lock:
+        return _catalog_entry(region)
+
+# SVM model mapping the gauge water levels (in mode order) to the z-score
+# threshold, loaded once per process and reloaded when the file changes
+zscore_model_path = 'h2zscore_svm_model_n3_0_i0.01.sav'
+_threshold_model = None
+_threshold_model_lock = threading.Lock()
+
+def get_threshold_model():
+    global _threshold_model
+    if _threshold_model is not None and _watching():
+        return _threshold_model[1]
+    stamp = _file_stamp(zscore_model_path)
+    with _threshold_model_lock:
+        if _threshold_model is None or _threshold_model[0] != stamp:
+            _threshold_model = (stamp, joblib.load(zscore_model_path))
+    return _threshold_model[1]
+
+def predict_zscore_threshold(water_level_list):
+    # (date, mode) or (mode,) water levels -> (date,) z-score thresholds in
+    # a single SVM predict
+    water_level_list = np.asarray(water_level_list, dtype='float64')
+    return get_threshold_model().predict(water_level_list.reshape(-1, water_level_list.shape[-1]))
+
+def _water_level_matrix(assets, water_levels):
+    # dates x gauges table keyed by hydrosite ID -> (date, mode) array
+    return np.column_stack([np.asarray(water_levels[site], dtype='float64') for site in assets.sites])
+
+def zscore_thresholds(region, water_levels):
+    # Thresholds for a dates x gauges DataFrame (or dict keyed by site)
+    return predict_zscore_threshold(_water_level_matrix(load_region(region), water_levels))
+
+# Hot reload: while an AssetWatcher runs, the loaders above serve whatever
+# is cached without touching the disk. The watcher polls the stamps of all
+# cached entries, rebuilds changed ones on its own thread once their files
+# have stopped changing for one interval, and swaps each new version into
+# its cache with a single assignment. Requests that already hold the old
+# objects finish on them; failed rebuilds keep the old version and retry.
+watch_interval = float(os.environ.get('FIER_WATCH_INTERVAL', 5))
+_watcher = None
+
+def _watching():
+    return _watcher is not None and _watcher.running
+
+class AssetWatcher:
+
+    def __init__(self, interval=None):
+        self.interval = interval or watch_interval
+        self.errors = {}
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='fier-asset-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def _settled(self, key, stamp):
+        # True once a changed stamp is seen on two polls in a row, so files
+        # still being copied are not loaded half written
+        if self._pending.get(key) == stamp:
+            del self._pending[key]
+            return True
+        self._pending[key] = stamp
+        return False
+
+    def _refresh(self, key, old_stamp, stamp_func, build_func, swap_func, reloaded):
+        try:
+            stamp = stamp_func()
+            if stamp[-1] == old_stamp:
+                self._pending.pop(key, None)
+                return
+            if self._settled(key, stamp[-1]):
+                swap_func((stamp[-1], build_func(*stamp)))
+                self.errors.pop(key, None)
+                reloaded.append(key)
+        except Exception as error:
+            self.errors[key] = repr(error)
 
-    dry_meanVV_dir = '%s/stats_img/500m/dry_meanVV.nc'%(region)
-    dry_meanVV = xr.open_dataset(root_output_folder + dry_meanVV_dir, engine="h5netcdf")
-    dry_meanVV = dry_meanVV.to_array().values[0,:,:]
+    def poll(self):
+        # One pass over the caches; returns the keys that were reloaded.
+        # Models go first since the TPC tables are built from them.
+        reloaded = []
+        for key, (old_stamp, model) in list(_tpc_registry.items()):
+            self._refresh(('tpc_model',) + key, old_stamp, lambda: (_file_stamp(key[0]),),
+                          lambda stamp: _read_tpc_model(*key), lambda entry: _tpc_registry.__setitem__(key, entry), reloaded)
+        if _threshold_model is not None:
+            def swap_threshold(entry):
+                global _threshold_model
+                _threshold_model = entry
+            self._refresh(('threshold_model',), _threshold_model[0], lambda: (_file_stamp(zscore_model_path),),
+                          lambda stamp: joblib.load(zscore_model_path), swap_threshold, reloaded)
+        for key, (old_stamp, tables) in list(_tpc_tables.items()):
+            self._refresh(('tpc_tables',) + key, old_stamp, lambda: _tpc_tables_stamp(*key),
+                          lambda model_files, stamp: _build_tpc_tables(*key, model_files), lambda entry: _tpc_tables.__setitem__(key, entry), reloaded)
+        with _region_cache_lock:
+            cached_regions = list(_region_cache.items())
+        for key, (old_stamp, assets) in cached_regions:
+            region, resolution, dtype = key
+            self._refresh(('region',) + key, old_stamp, lambda: _region_stamp(region, resolution, dtype),
+                          lambda manifest, stamp: _build_region(region, resolution, dtype, manifest, stamp), lambda entry: _replace_region(key, entry), reloaded)
+        return reloaded
 
+def start_watcher(interval=None):
+    # Process-wide AssetWatcher, started on the first call
+    global _watcher
+    if _watcher is None:
+        _watcher = AssetWatcher(interval)
+    return _watcher.start()
 
-    dry_stdVV_dir = '%s/stats_img/500m/dry_stdVV.nc'%(region)
-    dry_stdVV = xr.open_dataset(root_output_folder + dry_stdVV_dir, engine="h5netcdf")
-    dry_stdVV = dry_stdVV.to_array().values[0,:,:]
+# Pixels per block of the fused synthesis kernel; a block of every input and
+# output stays small enough to be cache resident.
+synthesis_block_size = 16384
+# Threads the kernels split the packed pixels over. NumPy releases the GIL
+# inside the dot products and ufuncs, so contiguous pixel ranges (row bands
+# of the AOI) run in parallel on a shared thread pool. The pool is created
+# with synthesis_threads workers on first use and never resized, so larger
+# n_threads requests are capped at its size.
+synthesis_threads = int(os.environ.get('FIER_THREADS', os.cpu_count() or 1))
+_synthesis_pool = None
+_synthesis_pool_lock = threading.Lock()
 
+def _synthesis_executor():
+    # (pool, number of workers)
+    global _synthesis_pool
+    with _synthesis_pool_lock:
+        if _synthesis_pool is None:
+            _synthesis_pool = (concurrent.futures.ThreadPoolExecutor(synthesis_threads, thread_name_prefix='fier-synthesis'), synthesis_threads)
+        return _synthesis_pool
+
+def _decoded_blocks(encoding, block, buffers, **arrays):
+    # {name: block of array}, decoded into the buffers for encoded assets
+    if encoding is None:
+        return {name: array[block] for name, array in arrays.items()}
+    return {name: _decode(array[block], *encoding[name], out=buffer) for (name, array), buffer in zip(arrays.items(), buffers)}
+
+def _run_tiles(tile, n_pixel, block_size, n_threads=None):
+    # Calls tile(start, stop) over n_threads block-aligned pixel ranges
+    n_threads = max(1, min(n_threads or synthesis_threads, synthesis_threads, -(-n_pixel//block_size)))
+    if n_threads > 1:
+        pool, pool_size = _synthesis_executor()
+        n_threads = min(n_threads, pool_size)
+    if n_threads == 1:
+        tile(0, n_pixel)
+        return
+    edges = [min(n_pixel, -(-n_pixel*k//n_threads//block_size)*block_size) for k in range(n_threads + 1)]
+    edges[-1] = n_pixel
+    futures = [pool.submit(tile, start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+    for future in futures:
+        future.result()
+
+def synthesis_kernel(modes, est_tpc, all_meanVV, dry_meanVV, dry_stdVV, zscore_threshold, block_size=None, out=None, n_threads=None, encoding=None):
+    # Single pass over pixel blocks writing the synthesized SAR (sum of
+    # modes*est_tpc plus all_meanVV), its z-score against the dry season
+    # statistics and the uint8 inundation map (z-score < threshold) into
+    # preallocated buffers. modes is (mode, pixel) and the statistics are
+    # (pixel,), e.g. the packed arrays of RegionAssets. A None entry in out
+    # is a product nobody asked for: it only lives in a block-sized scratch
+    # buffer, and the z-score is skipped when no later product needs it.
+    # The pixels are split into n_threads tiles (default and at most
+    # synthesis_threads).
+    # With an encoding (RegionAssets.encoding) the inputs are quantized and
+    # decoded per block; the mode scales and offsets fold into est_tpc.
+    block_size = block_size or synthesis_block_size
+    n_pixel = all_meanVV.shape[0]
+    float_dtype = modes.dtype if encoding is None else np.dtype(quantized_compute_dtype)
+    if out is None:
+        out = (np.empty(n_pixel, dtype=float_dtype), np.empty(n_pixel, dtype=float_dtype), np.empty(n_pixel, dtype='uint8'))
+    syn_sar, z_score_img, water_map = out
+    mode_offset = 0
+    if encoding is not None:
+        scale, offset, has_nan = encoding['modes']
+        mode_offset = float(np.dot(est_tpc, offset))
+        est_tpc = np.asarray(est_tpc)*scale
+    est_tpc = np.asarray(est_tpc, dtype=float_dtype)
+
+    def tile(tile_start, tile_stop):
+        scratch = np.empty((5, min(block_size, tile_stop - tile_start)), dtype=float_dtype)
+        for start in range(tile_start, tile_stop, block_size):
+            block = slice(start, min(start + block_size, tile_stop))
+            size = block.stop - block.start
+            stats = _decoded_blocks(encoding, block, scratch[2:, :size], all_meanVV=all_meanVV, dry_meanVV=dry_meanVV, dry_stdVV=dry_stdVV)
+            sar_block = scratch[0, :size] if syn_sar is None else syn_sar[block]
+            np.dot(est_tpc, modes[:, block], out=sar_block)
+            if mode_offset:
+                sar_block += mode_offset
+            sar_block += stats['all_meanVV']
+            if z_score_img is None and water_map is None:
+                continue
+            z_block = scratch[1, :size] if z_score_img is None else z_score_img[block]
+            np.subtract(sar_block, stats['dry_meanVV'], out=z_block)
+            z_block /= stats['dry_stdVV']
+            if water_map is not None:
+                np.less(z_block, zscore_threshold, out=water_map[block])
+
+    _run_tiles(tile, n_pixel, block_size, n_threads)
+    return syn_sar, z_score_img, water_map
+
+# Products of a synthesis, in synthesis_kernel order, and their output names
+products = ('sar', 'z_score', 'inundation')
+product_names = {'sar': 'Synthesized SAR Image', 'z_score': 'Z-score Image', 'inundation': 'Inundation Map'}
+
+class SynthesisResult:
+    # Lazy synthesize_sar result: TPCs and the threshold are estimated up
+    # front, each product is computed on first access. The requested
+    # products are computed together in one kernel pass; the others are
+    # never materialized unless accessed.
+
+    def __init__(self, assets, water_level, requested=products):
+        self.assets = assets
+        self.requested = tuple(requested)
+        self.water_level_list = np.array([float(water_level[site]) for site in assets.sites])
+        self.est_tpc = np.array([estimate_tpc(assets.region, site, ct_mode + 1, [value], assets.cv_results, resolution=assets.resolution)[0]
+                                 for ct_mode, (site, value) in enumerate(zip(assets.sites, self.water_level_list))])
+        self.zscore_threshold = predict_zscore_threshold(self.water_level_list)[0]
+        self._packed = {}
+        self._grids = {}
+
+    def packed(self, product):
+        if product not in self._packed:
+            wanted = [name for name in products if name == product or (name in self.requested and name not in self._packed)]
+            n_pixel = self.assets.modes.shape[1]
+            out = [np.empty(n_pixel, dtype='uint8' if name == 'inundation' else self.assets.float_dtype) if name in wanted else None
+                   for name in products]
+            assets = self.assets
+            synthesis_kernel(assets.modes, self.est_tpc, assets.all_meanVV, assets.dry_meanVV, assets.dry_stdVV, self.zscore_threshold, out=out, encoding=assets.encoding)
+            for name, buffer in zip(products, out):
+                if buffer is not None:
+                    self._packed[name] = buffer
+        return self._packed[product]
+
+    def grid(self, product):
+        if product not in self._grids:
+            self._grids[product] = self.assets.to_grid(self.packed(product), 0 if product == 'inundation' else np.nan)
+        return self._grids[product]
+
+    @property
+    def sar(self):
+        return self.grid('sar')
+
+    @property
+    def z_score(self):
+        return self.grid('z_score')
+
+    @property
+    def inundation(self):
+        return self.grid('inundation')
+
+def synthesize_products(region, water_level, requested=products, dtype=None, bbox=None, polygon=None, resolution=None):
+    # Lazy counterpart of synthesize_sar for callers that need only some of
+    # 'sar', 'z_score' and 'inundation'
+    return SynthesisResult(region_assets(region, dtype, bbox, polygon, resolution), water_level, requested)
+
+def _synthesize_assets(assets, water_level):
+    result = SynthesisResult(assets, water_level)
+    return result.sar, result.z_score, result.inundation
+
+def synthesize_sar(region, water_level, dtype=None, bbox=None, polygon=None, resolution=None):
+    # bbox = (south, west, north, east) or polygon = [(lon, lat), ...]
+    # restricts reading, synthesis and output to that region of interest
+    return _synthesize_assets(region_assets(region, dtype, bbox, polygon, resolution), water_level)
+
+# Grids of more pixels than in_memory_max_pixels are synthesized out of core
+# in row bands of about synthesis_tile_pixels pixels, e.g. 30m runs
+in_memory_max_pixels = int(os.environ.get('FIER_MAX_PIXELS', 50000000))
+synthesis_tile_pixels = 4000000
+
+def iter_synthesis_tiles(region, water_level, requested=products, dtype=None, bbox=None, polygon=None, resolution=None, tile_pixels=None):
+    # Out-of-core synthesis: yields (window, SynthesisResult) for row bands
+    # of the grid (or of its bbox/polygon part). Each band is read from disk
+    # on its own, so only one band of assets and products is held in memory.
+    resolution = _roi_resolution(region, bbox, polygon, resolution)
+    dims, coords, window = grid_window(region, bbox, polygon, resolution)
+    rows, cols = window['lat'], window['lon']
+    band_rows = max(1, (tile_pixels or synthesis_tile_pixels)//(cols.stop - cols.start))
+    dtype = np.dtype(dtype or compute_dtype).name
+    for start in range(rows.start, rows.stop, band_rows):
+        band = {'lat': slice(start, min(start + band_rows, rows.stop)), 'lon': cols}
+        assets = _read_region(region, polygon=polygon, resolution=resolution, window=band)
+        yield band, SynthesisResult(assets if dtype == assets.storage_dtype else assets.astype(dtype), water_level, requested)
+
+# Lazy backend: the assets are opened as dask-backed xarray variables in
+# lazy_chunk_size x lazy_chunk_size spatial chunks and the synthesis is a
+# task graph that a dask scheduler runs chunk by chunk. Needs dask.
+lazy_chunk_size = int(os.environ.get('FIER_LAZY_CHUNK', 2048))
+
+def synthesize_sar_lazy(region, water_level, dtype=None, bbox=None, polygon=None, resolution=None, chunks=None):
+    # Lazy counterpart of synthesize_sar: a Dataset of dask-backed SAR,
+    # z-score and inundation variables (named as in product_names). Nothing
+    # is read before it is computed or written, e.g. by write_lazy_output.
+    chunks = chunks or lazy_chunk_size
+    resolution = _roi_resolution(region, bbox, polygon, resolution)
+    spatial_chunks = {'lat': chunks, 'lon': chunks}
+    # The lazy backend reads the float source files, so an encoding only
+    # selects the float type it decodes to
+    dtype = _float_dtype(dtype or compute_dtype)
+    dims, coords, window = grid_window(region, bbox, polygon, resolution)
+
+    def open_variable(kind, name, variable=None):
+        # Positional (coordinate free) lazy variable cropped to the window
+        dataset = xr.open_dataset(asset_path(region, kind, name, resolution), engine="h5netcdf", chunks=dict(spatial_chunks, mode=-1))
+        array = dataset[variable or list(dataset.data_vars)[0]].isel(window)
+        return array.drop_vars([name for name in array.coords], errors='ignore').astype(dtype)
+
+    with xr.open_dataset(asset_path(region, 'RSM', 'RSM_hydro.nc', resolution), engine="h5netcdf") as RSM:
+        sites = [str(RSM.hydro_site.sel(mode = ct_mode + 1).values) for ct_mode in range(len(RSM.mode.values))]
+    df_cv_results= pd.read_excel(asset_path(region, 'TF_model', 'GridsearchCV_results.xlsx', resolution), index_col=0)
+    water_level_list = np.array([float(water_level[site]) for site in sites])
+    est_tpc = np.array([estimate_tpc(region, site, ct_mode + 1, [value], df_cv_results, resolution=resolution)[0]
+                        for ct_mode, (site, value) in enumerate(zip(sites, water_level_list))])
+    zscore_threshold = predict_zscore_threshold(water_level_list)[0]
+
+    spatial_modes = open_variable('RSM', 'RSM_hydro.nc', 'spatial_modes')
+    all_meanVV = open_variable('stats_img', 'all_meanVV.nc')
+    dry_meanVV = open_variable('stats_img', 'dry_meanVV.nc')
+    dry_stdVV = open_variable('stats_img', 'dry_stdVV.nc')
+    if polygon is not None:
+        path = matplotlib.path.Path(np.asarray(polygon, dtype='float64'))
+        # Chunked like the windowed sources, whose chunk boundaries follow
+        # the full grid rather than the window origin
+        lon, lat = xr.broadcast(xr.DataArray(coords['lon'].values, dims='lon').chunk({'lon': dry_meanVV.chunksizes['lon']}),
+                                xr.DataArray(coords['lat'].values, dims='lat').chunk({'lat': dry_meanVV.chunksizes['lat']}))
+        inside = xr.apply_ufunc(lambda lon, lat: path.contains_points(np.column_stack([lon.reshape(-1), lat.reshape(-1)])).reshape(lon.shape),
+                                lon, lat, dask='parallelized', output_dtypes=[bool])
+        dry_meanVV = dry_meanVV.where(inside)
+
+    syn_sar = (spatial_modes*xr.DataArray(est_tpc.astype(dtype), dims='mode')).sum('mode') + all_meanVV
     z_score_img = (syn_sar-dry_meanVV)/dry_stdVV
+    water_map = (z_score_img < zscore_threshold).astype('uint8')
+
+    return xr.Dataset({product_names['sar']: syn_sar.transpose(*dims),
+                       product_names['z_score']: z_score_img.transpose(*dims),
+                       product_names['inundation']: water_map.transpose(*dims)},
+                      coords = coords)
+
+def _init_output_nc(nc_file, dims, coords, variables):
+    # Dimensions, coordinates and empty {name: dtype} variables of an open
+    # h5netcdf output file that is filled band by band
+    nc_file.dimensions = {name: coords[name].size for name in dims}
+    for name in dims:
+        variable = nc_file.create_variable(name, (name,), data=coords[name].values)
+        variable.attrs.update(coords[name].attrs)
+    for name, dtype in variables.items():
+        nc_file.create_variable(name, dims, dtype, chunks=True)
+
+def write_lazy_output(dataset, path='output/output.nc', scheduler='threads', num_workers=None):
+    # Writes a synthesize_sar_lazy Dataset to NetCDF one row of chunks at a
+    # time, each computed on a local 'threads' or 'processes' dask
+    # scheduler, so peak memory stays around one band of chunks
+    dims = dataset[product_names['sar']].dims
+    with h5netcdf.File(path, 'w') as nc_file:
+        _init_output_nc(nc_file, dims, dataset.coords, {name: dataset[name].dtype for name in dataset.data_vars})
+        start = 0
+        for size in dataset.chunks['lat']:
+            band = dataset.isel(lat=slice(start, start + size)).compute(scheduler=scheduler, num_workers=num_workers)
+            index = tuple(slice(start, start + size) if name == 'lat' else slice(None) for name in dims)
+            for name in band.data_vars:
+                nc_file[name][index] = band[name].values
+            start += size
+    return path
+
+def iter_synthesize_sar(region, water_levels, chunk_size=32, dtype=None, resolution=None):
+    # water_levels: dates x gauges matrix, e.g. a DataFrame with one column per
+    # hydrosite ID. Yields (time slice, SAR, z-score, inundation) cubes of at
+    # most chunk_size dates so memory stays bounded for multi-year hindcasts.
+    assets = load_region(region, dtype, resolution).decoded()
+    water_level_list = _water_level_matrix(assets, water_levels)
 
-    # Inundation Map
+    # One batched predict per TPC model: (time, mode)
+    est_tpc = np.empty(water_level_list.shape)
+    for ct_mode, site in enumerate(assets.sites):
+        est_tpc[:,ct_mode] = estimate_tpc(region, site, ct_mode + 1, water_level_list[:,ct_mode], assets.cv_results, resolution=assets.resolution)
 
-    aoi_indx = np.argwhere(~np.isnan(dry_meanVV))
-    water_indx = np.argwhere( z_score_img < zscore_threshold )
-    water_map = np.empty((syn_sar.shape[0], syn_sar.shape[1]))
-    water_map[:] = 0
-    water_map[aoi_indx[:,0], aoi_indx[:,1]] = 0
-    water_map[water_indx[:,0], water_indx[:,1]] = 1
-    # water_map[water_map == 2] = np.nan
+    zscore_threshold = predict_zscore_threshold(water_level_list)
 
-    # water_map = z_score_img.copy()
-    # water_map[z_score_img < zscore_threshold] = 1
-    # water_map[z_score_img >= zscore_threshold] = 0
+    n_time = water_level_list.shape[0]
+    for start in range(0, n_time, chunk_size):
+        stop = min(start + chunk_size, n_time)
+        # (time, mode) x (mode, pixel) -> (time, pixel)
+        syn_sar = est_tpc[start:stop].astype(assets.modes.dtype) @ assets.modes
+        syn_sar += assets.all_meanVV
+        z_score_img = (syn_sar-assets.dry_meanVV)/assets.dry_stdVV
+        water_map = (z_score_img < zscore_threshold[start:stop, None]).astype('uint8')
 
-    #print(syn_sar.shape, water_map.shape)
+        yield slice(start, stop), assets.to_grid(syn_sar), assets.to_grid(z_score_img), assets.to_grid(water_map, 0)
 
-    RSM.close()
+def synthesize_sar_batch(region, water_levels, chunk_size=32, dtype=None, resolution=None):
+    syn_sar = z_score_img = water_map = None
+    for time_slice, sar_chunk, z_chunk, water_chunk in iter_synthesize_sar(region, water_levels, chunk_size, dtype, resolution):
+        if syn_sar is None:
+            shape = (len(water_levels[next(iter(water_levels))]),) + sar_chunk.shape[1:]
+            syn_sar, z_score_img, water_map = np.empty(shape, dtype=sar_chunk.dtype), np.empty(shape, dtype=sar_chunk.dtype), np.empty(shape, dtype='uint8')
+        syn_sar[time_slice] = sar_chunk
+        z_score_img[time_slice] = z_chunk
+        water_map[time_slice] = water_chunk
 
     return syn_sar, z_score_img, water_map
 
-def image_output(region, water_level):
+def zscore_kernel(syn_sar, dry_meanVV, dry_stdVV, zscore_threshold, block_size=None, out=None, n_threads=None, encoding=None):
+    # Z-score and inundation passes of synthesis_kernel for an existing
+    # packed synthesized SAR
+    block_size = block_size or synthesis_block_size
+    n_pixel = syn_sar.shape[0]
+    if out is None:
+        out = (np.empty(n_pixel, dtype=syn_sar.dtype), np.empty(n_pixel, dtype='uint8'))
+    z_score_img, water_map = out
 
+    def tile(tile_start, tile_stop):
+        scratch = np.empty((2, min(block_size, tile_stop - tile_start)), dtype=syn_sar.dtype)
+        for start in range(tile_start, tile_stop, block_size):
+            block = slice(start, min(start + block_size, tile_stop))
+            stats = _decoded_blocks(encoding, block, scratch[:, :block.stop - block.start], dry_meanVV=dry_meanVV, dry_stdVV=dry_stdVV)
+            z_block = z_score_img[block]
+            np.subtract(syn_sar[block], stats['dry_meanVV'], out=z_block)
+            z_block /= stats['dry_stdVV']
+            np.less(z_block, zscore_threshold, out=water_map[block])
+
+    _run_tiles(tile, n_pixel, block_size, n_threads)
+    return z_score_img, water_map
+
+class IncrementalSynthesizer:
+    # Keeps the last synthesized SAR of a session or forecast sequence and,
+    # when only some gauges change, applies spatial_mode_k * dTPC_k for the
+    # affected modes instead of rebuilding the image. A full synthesis is
+    # redone every refresh_every updates to bound accumulated rounding.
+    refresh_every = 64
+
+    def __init__(self, region, dtype=None, resolution=None):
+        self.region = region
+        self.dtype = dtype
+        self.resolution = resolution
+        self.assets = None
+        self.water_level_list = None
+        self.est_tpc = None
+        self.tpc_version = None
+        self.n_update = 0
+
+    def _apply_delta(self, ct_mode, delta, block_size=None):
+        block_size = block_size or synthesis_block_size
+        sm = self.assets.modes[ct_mode]
+        offset = 0
+        if self.assets.encoding is not None:
+            scale, offset, has_nan = self.assets.encoding['modes']
+            delta, offset = delta*scale[ct_mode], delta*offset[ct_mode]
+        buffer = np.empty(min(block_size, len(sm)), dtype=self.syn_sar.dtype)
+        for start in range(0, len(sm), block_size):
+            block = slice(start, min(start + block_size, len(sm)))
+            term = buffer[:block.stop - block.start]
+            np.multiply(sm[block], delta, out=term, dtype=term.dtype)
+            if offset:
+                term += offset
+            self.syn_sar[block] += term
+
+    def update(self, water_level, packed=False):
+        assets = load_region(self.region, self.dtype, self.resolution)
+        water_level_list = np.array([float(water_level[site]) for site in assets.sites])
+        zscore_threshold = predict_zscore_threshold(water_level_list)[0]
+        # Read before estimating, so a model swapped in meanwhile only
+        # causes one more full synthesis on the next update
+        version = tpc_version(self.region, assets.sites, resolution=assets.resolution)
+
+        if assets is not self.assets or version != self.tpc_version or self.n_update >= self.refresh_every:
+            # First call, reloaded assets or TPC models, or periodic
+            # refresh: full synthesis
+            self.assets = assets
+            self.tpc_version = version
+            self.est_tpc = np.array([estimate_tpc(self.region, site, ct_mode + 1, [value], assets.cv_results, resolution=assets.resolution)[0]
+                                     for ct_mode, (site, value) in enumerate(zip(assets.sites, water_level_list))])
+            self.syn_sar, self.z_score_img, self.water_map = synthesis_kernel(assets.modes, self.est_tpc, assets.all_meanVV, assets.dry_meanVV, assets.dry_stdVV, zscore_threshold, encoding=assets.encoding)
+            self.changed_modes = list(range(assets.n_mode))
+            self.n_update = 0
+        else:
+            self.changed_modes = list(np.flatnonzero(water_level_list != self.water_level_list))
+            for ct_mode in self.changed_modes:
+                est_tpc = estimate_tpc(self.region, assets.sites[ct_mode], ct_mode + 1, [water_level_list[ct_mode]], assets.cv_results, resolution=assets.resolution)[0]
+                self._apply_delta(ct_mode, est_tpc - self.est_tpc[ct_mode])
+                self.est_tpc[ct_mode] = est_tpc
+            zscore_kernel(self.syn_sar, assets.dry_meanVV, assets.dry_stdVV, zscore_threshold, out=(self.z_score_img, self.water_map), encoding=assets.encoding)
+            self.n_update += 1
+        self.water_level_list = water_level_list
+
+        if packed:
+            return self.syn_sar, self.z_score_img, self.water_map
+        return assets.to_grid(self.syn_sar), assets.to_grid(self.z_score_img), assets.to_grid(self.water_map, 0)
+
+def session_synthesizer(region, resolution=None):
+    # One IncrementalSynthesizer per Streamlit session, region and resolution
+    resolution = resolution or default_resolution
+    key = 'synthesizer_%s_%s'%(region, resolution)
+    if key not in st.session_state:
+        st.session_state[key] = IncrementalSynthesizer(region, resolution=resolution)
+    return st.session_state[key]
+
+def _packed_position(assets, pixels):
+    # (rows, cols) grid indices -> positions in the packed AOI arrays, -1
+    # for pixels outside the AOI
+    rows, cols = (np.asarray(indices).reshape(-1) for indices in pixels)
+    flat = rows*assets.shape[1] + cols
+    position = np.searchsorted(assets.index, flat)
+    position[position == len(assets.index)] = 0
+    return np.where(assets.index[position] == flat, position, -1)
+
+def flood_onset_level(region, site, water_level, pixels=None, zscore_threshold=None, resolution=None):
+    # Lowest water level of one gauge at which each pixel floods, with the
+    # other gauges held at water_level. Once the z-score threshold is fixed
+    # (by default the SVM threshold at water_level) a pixel floods when
+    #   sum_k sm_k*tpc_k < threshold*dry_stdVV + dry_meanVV - all_meanVV,
+    # so the gauge's own TPC only has to cross a per-pixel bound, which is
+    # solved on its TPC table. pixels is (rows, cols) or None for the whole
+    # grid. -inf: flooded over the whole table range, NaN: never floods.
+    assets = load_region(region, 'float64', resolution)
+    ct_modes = [ct_mode for ct_mode, mode_site in enumerate(assets.sites) if mode_site == site]
+    if len(ct_modes) != 1:
+        raise ValueError('%s drives %d modes; flood onset needs exactly one'%(site, len(ct_modes)))
+    ct_mode = ct_modes[0]
+    table = load_tpc_tables(region, assets.resolution)[ct_mode + 1]
+
+    water_level_list = np.array([float(water_level[mode_site]) for mode_site in assets.sites])
+    if zscore_threshold is None:
+        zscore_threshold = predict_zscore_threshold(water_level_list)[0]
+    est_tpc = np.array([estimate_tpc(region, mode_site, other_mode + 1, [value], assets.cv_results, resolution=assets.resolution)[0]
+                        for other_mode, (mode_site, value) in enumerate(zip(assets.sites, water_level_list))])
+    est_tpc[ct_mode] = 0
+
+    if pixels is None:
+        position = slice(None)
+    else:
+        position = _packed_position(assets, pixels)
+    sm = assets.modes[:, position]
+    bound = zscore_threshold*assets.dry_stdVV[position] + assets.dry_meanVV[position] - assets.all_meanVV[position] - est_tpc @ sm
+    sm_site = sm[ct_mode]
+
+    # Flood when sm_site*tpc < bound: tpc < bound/sm_site for positive
+    # coefficients, tpc > bound/sm_site for negative ones. The running min
+    # (max) of the table gives the first crossing level by bisection.
+    levels, tpcs = table.water_levels, table.tpcs
+    n_level = len(levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpc_bound = bound/sm_site
+    first = np.full(tpc_bound.shape, n_level)
+    rising = sm_site > 0
+    running_min = np.minimum.accumulate(tpcs)
+    first[rising] = n_level - np.searchsorted(running_min[::-1], tpc_bound[rising], side='left')
+    falling = sm_site < 0
+    running_max = np.maximum.accumulate(tpcs)
+    first[falling] = np.searchsorted(running_max, tpc_bound[falling], side='right')
+
+    onset = np.full(tpc_bound.shape, np.nan)
+    crossing = (first > 0) & (first < n_level)
+    upper = first[crossing]
+    fraction = (tpc_bound[crossing] - tpcs[upper - 1])/(tpcs[upper] - tpcs[upper - 1])
+    onset[crossing] = levels[upper - 1] + fraction*(levels[upper] - levels[upper - 1])
+    onset[first == 0] = -np.inf
+    # A zero coefficient makes the pixel independent of this gauge
+    onset[(sm_site == 0) & (bound > 0)] = -np.inf
+    onset[~np.isfinite(bound)] = np.nan
+
+    if pixels is None:
+        return assets.to_grid(onset)
+    onset[position < 0] = np.nan
+    return onset
+
+def flood_probability(region, water_level, water_level_std, dtype=None, delta=0.01, resolution=None):
+    # Per-pixel flood probability for Gaussian water-level uncertainty
+    # (water_level_std: {site: std in m}). The TPC models and the SVM
+    # threshold are expanded around the forecast levels by central
+    # differences, so the flood margin threshold*dry_stdVV + dry_meanVV - SAR
+    # is Gaussian with variance
+    #   sum_gauge std_g**2 * (dthr/dh_g * dry_stdVV - sum_{k of gauge g} sm_k * dTPC_k/dh)**2
+    # and a mean that includes the second order terms 0.5*f''*std**2 of the
+    # TPCs and the threshold; P(flood) = P(margin > 0).
+    assets = load_region(region, dtype, resolution).decoded()
+    water_level_list = np.array([float(water_level[site]) for site in assets.sites])
+    mode_std = np.array([float(water_level_std.get(site, 0)) for site in assets.sites])
+    est_tpc = np.empty(assets.n_mode)
+    slope = np.empty(assets.n_mode)
+    for ct_mode, (site, value) in enumerate(zip(assets.sites, water_level_list)):
+        center, lower, upper = estimate_tpc(region, site, ct_mode + 1, [value, value - delta, value + delta], assets.cv_results, resolution=assets.resolution)
+        slope[ct_mode] = (upper - lower)/(2*delta)
+        est_tpc[ct_mode] = center + 0.5*(upper + lower - 2*center)/delta**2*mode_std[ct_mode]**2
+
+    # Forecast threshold and central differences per gauge in one predict:
+    # rows 2g+1 and 2g+2 move every mode column of gauge g by +delta/-delta
+    gauges = sorted(set(assets.sites))
+    gauge_std = np.array([float(water_level_std.get(site, 0)) for site in gauges])
+    rows = [water_level_list]
+    for site in gauges:
+        columns = np.array([mode_site == site for mode_site in assets.sites])
+        rows += [water_level_list + delta*columns, water_level_list - delta*columns]
+    thresholds = predict_zscore_threshold(np.array(rows))
+    upper, lower = thresholds[1::2], thresholds[2::2]
+    threshold_slope = (upper - lower)/(2*delta)
+    zscore_threshold = thresholds[0] + 0.5*((upper + lower - 2*thresholds[0])/delta**2*gauge_std**2).sum()
+    syn_sar, z_score_img, water_map = synthesis_kernel(assets.modes, est_tpc, assets.all_meanVV, assets.dry_meanVV, assets.dry_stdVV, zscore_threshold)
+
+    # (gauge, mode) SAR sensitivities and gauge threshold sensitivities,
+    # scaled by each gauge's spread
+    spread = np.zeros((len(gauges), assets.n_mode), dtype=assets.modes.dtype)
+    for ct_mode, site in enumerate(assets.sites):
+        spread[gauges.index(site), ct_mode] = slope[ct_mode]*gauge_std[gauges.index(site)]
+    threshold_spread = (threshold_slope*gauge_std).astype(assets.modes.dtype)
+    margin_spread = threshold_spread[:, None]*assets.dry_stdVV - spread @ assets.modes
+    margin_std = np.sqrt(np.square(margin_spread).sum(axis=0))
+
+    margin = zscore_threshold*assets.dry_stdVV + assets.dry_meanVV - syn_sar
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probability = scipy.special.ndtr(margin/margin_std)
+    # No spread: the deterministic map
+    certain = margin_std == 0
+    probability[certain] = water_map[certain]
+
+    return assets.to_grid(probability)
+
+def _init_ensemble_worker(output_folder, backend):
+    # The workers already occupy the cores: no synthesis threads on top
+    global root_output_folder, tpc_backend, synthesis_threads
+    root_output_folder, tpc_backend, synthesis_threads = output_folder, backend, 1
+
+def _exceedance_counts(region, water_level_list, chunk_size, dtype, resolution=None):
+    # Per-pixel number of members of a (member, mode) water-level matrix
+    # whose z-score falls below their own SVM threshold
+    assets = load_region(region, dtype, resolution).decoded()
+    est_tpc = np.empty(water_level_list.shape)
+    for ct_mode, site in enumerate(assets.sites):
+        est_tpc[:,ct_mode] = estimate_tpc(region, site, ct_mode + 1, water_level_list[:,ct_mode], assets.cv_results, resolution=assets.resolution)
+    est_tpc = est_tpc.astype(assets.modes.dtype)
+    zscore_threshold = predict_zscore_threshold(water_level_list)
+
+    counts = np.zeros(assets.modes.shape[1], dtype='int64')
+    for start in range(0, len(water_level_list), chunk_size):
+        stop = min(start + chunk_size, len(water_level_list))
+        z_score_img = est_tpc[start:stop] @ assets.modes
+        z_score_img += assets.all_meanVV
+        z_score_img -= assets.dry_meanVV
+        z_score_img /= assets.dry_stdVV
+        counts += (z_score_img < zscore_threshold[start:stop, None]).sum(axis=0)
+    return counts
+
+def sample_members(water_level, water_level_std, n_member, chunk_size=1000, seed=None):
+    # Gaussian water-level ensemble as a stream of (member x gauge) chunks
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_member, chunk_size):
+        size = min(chunk_size, n_member - start)
+        yield pd.DataFrame({site: rng.normal(float(value), float(water_level_std.get(site, 0)), size)
+                            for site, value in water_level.items()})
+
+def ensemble_flood_probability(region, members, chunk_size=256, n_workers=None, dtype=None, resolution=None):
+    # Probability of inundation over an ensemble of water-level vectors.
+    # members is a (member x gauge) DataFrame or an iterable of such chunks,
+    # e.g. sample_members(); only per-pixel exceedance counts are kept, so
+    # memory stays O(pixels) however many members are streamed through.
+    # Chunks run on a process pool of n_workers (default: all cores).
+    assets = load_region(region, dtype, resolution)
+    if isinstance(members, (pd.DataFrame, dict)):
+        members = [members]
+    n_workers = n_workers or os.cpu_count()
+
+    counts = np.zeros(assets.modes.shape[1], dtype='int64')
+    n_member = 0
+    if n_workers == 1:
+        for chunk in members:
+            water_level_list = _water_level_matrix(assets, chunk)
+            counts += _exceedance_counts(region, water_level_list, chunk_size, dtype, resolution)
+            n_member += len(water_level_list)
+        return assets.to_grid(counts/n_member)
+
+    with concurrent.futures.ProcessPoolExecutor(n_workers, initializer=_init_ensemble_worker, initargs=(root_output_folder, tpc_backend)) as pool:
+        pending = set()
+        for chunk in members:
+            water_level_list = _water_level_matrix(assets, chunk)
+            # Split large chunks so every worker gets a share
+            for task in np.array_split(water_level_list, max(1, min(n_workers, len(water_level_list)//chunk_size))):
+                pending.add(pool.submit(_exceedance_counts, region, task, chunk_size, dtype, resolution))
+                n_member += len(task)
+                # Bound the number of chunks in flight
+                if len(pending) >= 2*n_workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        counts += future.result()
+        for future in concurrent.futures.as_completed(pending):
+            counts += future.result()
+
+    return assets.to_grid(counts/n_member)
+
+def gauge_ranges(region, n_std=3, resolution=None):
+    # {site: (low, high, mean)} water levels covered by each gauge's TPC
+    # model training data, e.g. for what-if sliders
+    ranges = {}
+    for mode, site, path in _tpc_model_files(region, resolution):
+        low, high = get_tpc_model(region, site, mode, 'numpy', resolution).value_range(n_std)
+        ranges[site] = (round(low, 2), round(high, 2), round((low + high)/2, 2))
+    return ranges
+
+# Overlay colors of the inundation map: (R, G, B, alpha) of dry and flooded
+flood_palette = ((192, 192, 192, 13), (0, 0, 139, 178))
+
+def inundation_png(water_map):
+    # Palette PNG of a uint8 inundation map, one byte per pixel before
+    # compression, north-up as stored in the stats images
+    image = Image.fromarray(np.ascontiguousarray(water_map, dtype='uint8'), mode='P')
+    image.putpalette([channel for color in flood_palette for channel in color[:3]])
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', transparency=bytes(color[3] for color in flood_palette), optimize=False)
+    return buffer.getvalue()
+
+def whatif_overlay(region, water_level, synthesizer=None):
+    # (data URL, bounds) of the inundation overlay for interactive what-if
+    # runs: resident assets and models, incremental synthesis, nothing
+    # written to disk
+    if synthesizer is None:
+        synthesizer = IncrementalSynthesizer(region)
+    syn_sar, z_score_img, water_map = synthesizer.update(water_level, packed=True)
+    assets = synthesizer.assets
+    water_map = assets.to_grid(water_map, 0)
+    if assets.coords['lat'].values[0] < assets.coords['lat'].values[-1]:
+        water_map = water_map[::-1]
+    url = 'data:image/png;base64,' + base64.b64encode(inundation_png(water_map)).decode()
+    return url, assets.bounds
+
+class PointQuery:
+    # Flood status and z-score at many lat/lon points over many dates. The
+    # point -> packed pixel mapping and the mode/statistics values at the
+    # points are gathered once; evaluate() never allocates a full grid.
+
+    def __init__(self, region, lats, lons, dtype=None, resolution=None):
+        self.region = region
+        self.assets = load_region(region, dtype, resolution).decoded()
+        rows, cols = self.assets.pixel_index(lats, lons)
+        position = _packed_position(self.assets, (rows, cols))
+        position[rows < 0] = -1
+        self.inside = position >= 0
+        gather = np.where(self.inside, position, 0)
+        self.modes = self.assets.modes[:, gather]
+        self.all_meanVV = self.assets.all_meanVV[gather]
+        self.dry_meanVV = np.where(self.inside, self.assets.dry_meanVV[gather], np.nan)
+        self.dry_stdVV = self.assets.dry_stdVV[gather]
+
+    def evaluate(self, water_levels, index=None):
+        # water_levels: dates x gauges table keyed by hydrosite ID. Returns
+        # (z-score, flooded) DataFrames of points x dates; points outside the
+        # AOI have a NaN z-score and are never flooded.
+        assets = self.assets
+        water_level_list = _water_level_matrix(assets, water_levels)
+        est_tpc = np.empty(water_level_list.shape)
+        for ct_mode, site in enumerate(assets.sites):
+            est_tpc[:,ct_mode] = estimate_tpc(self.region, site, ct_mode + 1, water_level_list[:,ct_mode], assets.cv_results, resolution=assets.resolution)
+        zscore_threshold = predict_zscore_threshold(water_level_list)
+
+        # (date, mode) x (mode, point) -> (point, date)
+        z_score = ((est_tpc.astype(self.modes.dtype) @ self.modes + self.all_meanVV - self.dry_meanVV)/self.dry_stdVV).T
+        flooded = (z_score < zscore_threshold).astype('uint8')
+        columns = water_levels.index if isinstance(water_levels, pd.DataFrame) else None
+        return pd.DataFrame(z_score, index=index, columns=columns), pd.DataFrame(flooded, index=index, columns=columns)
+
+def compare_precision(region, water_levels, dtype='float32', chunk_size=32, resolution=None):
+    # Per-date accuracy of a reduced precision run against float64 for a
+    # dates x gauges water-level matrix: max abs z-score error over the AOI
+    # and the number of inundation pixels that flip.
+    report = []
+    reference = iter_synthesize_sar(region, water_levels, chunk_size, 'float64', resolution)
+    reduced = iter_synthesize_sar(region, water_levels, chunk_size, dtype, resolution)
+    for (time_slice, _, z_ref, map_ref), (_, _, z_low, map_low) in zip(reference, reduced):
+        z_error = np.abs(z_low.astype('float64') - z_ref).reshape(len(z_ref), -1)
+        flipped = (map_low != map_ref).reshape(len(map_ref), -1).sum(axis=1)
+        for ct_time in range(len(z_ref)):
+            report.append({'time': time_slice.start + ct_time,
+                           'max_abs_zscore_error': float(np.nanmax(z_error[ct_time])),
+                           'flipped_pixels': int(flipped[ct_time])})
+    report = pd.DataFrame(report).set_index('time')
+    if isinstance(water_levels, pd.DataFrame):
+        report.index = water_levels.index
+    return report
+
+# Longest side in pixels of output.jpg for out-of-core outputs
+jpg_max_pixels = 4096
+
+def _tiled_image_output(region, water_level, folder_name, bbox, polygon, requested, resolution):
+    # image_output for grids too large for memory: output.nc and output.tiff
+    # are written band by band from iter_synthesis_tiles
+    import rasterio
+    import rasterio.transform
+    import rasterio.windows
+    dims, coords, window = grid_window(region, bbox, polygon, resolution)
+    requested = [name for name in products if name in requested]
+    lat, lon = coords['lat'].values, coords['lon'].values
+    dlat = (lat[-1] - lat[0])/max(len(lat) - 1, 1)
+    dlon = (lon[-1] - lon[0])/max(len(lon) - 1, 1)
+    transform = rasterio.transform.Affine(dlon, 0, lon[0] - dlon/2, 0, dlat, lat[0] - dlat/2)
+
+    tiff = None
+    with h5netcdf.File(folder_name + '/output.nc', 'w') as nc_file:
+        _init_output_nc(nc_file, dims, coords, {product_names[name]: 'uint8' if name == 'inundation' else _float_dtype(compute_dtype) for name in requested})
+        if 'inundation' in requested:
+            tiff = rasterio.open(folder_name + '/output.tiff', 'w', driver='GTiff', height=len(lat), width=len(lon), count=1,
+                                 dtype='uint8', crs='EPSG:4326', transform=transform)
+        try:
+            for band, result in iter_synthesis_tiles(region, water_level, requested, bbox=bbox, polygon=polygon, resolution=resolution):
+                rows = slice(band['lat'].start - window['lat'].start, band['lat'].stop - window['lat'].start)
+                index = tuple(rows if name == 'lat' else slice(None) for name in dims)
+                for name in requested:
+                    nc_file[product_names[name]][index] = result.grid(name)
+                if tiff is not None:
+                    tiff.write(result.grid('inundation'), 1, window=rasterio.windows.Window(0, rows.start, len(lon), rows.stop - rows.start))
+        finally:
+            if tiff is not None:
+                tiff.close()
+
+    if 'inundation' in requested:
+        # Decimated preview of the inundation map
+        step = max(1, -(-max(len(lat), len(lon))//jpg_max_pixels))
+        with xr.open_dataset(folder_name + '/output.nc', engine="h5netcdf") as nc_file:
+            plt.imshow(nc_file['Inundation Map'][::step, ::step])
+            plt.savefig(folder_name + "/output.jpg")
+            plt.close()
+
+    return folder_name
+
+def validate_encoding(region, water_levels, encoding='int16', chunk_size=32, resolution=None):
+    # compare_precision report of an asset encoding against float64 for a
+    # dates x gauges water-level matrix; report.attrs has the storage size
+    # of the packed arrays relative to float64
+    report = compare_precision(region, water_levels, encoding, chunk_size, resolution)
+    reference = load_region(region, 'float64', resolution)
+    encoded = load_region(region, encoding, resolution)
+    nbytes = lambda assets: sum(getattr(assets, name).nbytes for name in ('modes', 'all_meanVV', 'dry_meanVV', 'dry_stdVV'))
+    report.attrs['compression'] = nbytes(reference)/nbytes(encoded)
+    report.attrs['max_abs_zscore_error'] = float(report.max_abs_zscore_error.max())
+    report.attrs['max_flipped_pixels'] = int(report.flipped_pixels.max())
+    return report
+
+def image_output(region, water_level, synthesizer=None, bbox=None, polygon=None, requested=products, resolution=None):
+
+    # Only the requested products are computed and written; the JPG and
+    # TIFF are made from the inundation map
     folder_name = 'output'
-    sar_image, z_score_image, water_map_image = synthesize_sar(region, water_level)
+    resolution = _roi_resolution(region, bbox, polygon, resolution)
+    if synthesizer is None or bbox is not None or polygon is not None:
+        dims, coords, window = grid_window(region, bbox, polygon, resolution)
+        if coords['lat'].size*coords['lon'].size > in_memory_max_pixels:
+            return _tiled_image_output(region, water_level, folder_name, bbox, polygon, requested, resolution)
+
+    if synthesizer is not None and bbox is None and polygon is None:
+        packed = dict(zip(products, synthesizer.update(water_level, packed=True)))
+        assets = synthesizer.assets
+        images = {name: assets.to_grid(packed[name], 0 if name == 'inundation' else np.nan) for name in requested}
+    else:
+        # Only the ROI window is read, computed and written
+        result = synthesize_products(region, water_level, requested, bbox=bbox, polygon=polygon, resolution=resolution)
+        assets = result.assets
+        images = {name: result.grid(name) for name in requested}
 
     # fig = plt.figure()
     # plt.imshow(sar_image, cmap='gray')
@@ -126,41 +2034,37 @@ def image_output(region, water_level):
     # plt.show()
 
     # Make nc file:
-    all_meanVV_dir = '%s/stats_img/500m/all_meanVV.nc'%(region)
-    all_meanVV = xr.open_dataset(root_output_folder + all_meanVV_dir, engine="h5netcdf")
-    
     out_file = xr.Dataset(
-        {
-            "Synthesized SAR Image": (
-                all_meanVV.dims,
-                sar_image
-                            ),
-            "Z-score Image": (
-                all_meanVV.dims,
-                z_score_image,
-                             ),
-            "Inundation Map": (
-                all_meanVV.dims,
-                water_map_image,
-                     ),
-        },
-        coords = all_meanVV.coords,
+        {product_names[name]: (assets.dims, images[name]) for name in products if name in images},
+        coords = assets.coords,
     )
-    all_meanVV.close()
     out_file.to_netcdf(folder_name +'/output.nc', engine="h5netcdf")
-    
-    nc_file = xr.open_dataset('output/output.nc', engine="h5netcdf")
-    innudation_map = nc_file['Inundation Map']
 
-    plt.imshow(innudation_map)
-    plt.savefig("output/output.jpg")
-    plt.close()
-    
-    innudation_map = innudation_map.rio.set_spatial_dims('lon', 'lat')
-    innudation_map.rio.set_crs("epsg:4326")
-    innudation_map.rio.to_raster("output/output.tiff")
-    
-    nc_file.close()
+    if 'inundation' in images:
+        nc_file = xr.open_dataset('output/output.nc', engine="h5netcdf")
+        innudation_map = nc_file['Inundation Map']
+
+        plt.imshow(innudation_map)
+        plt.savefig("output/output.jpg")
+        plt.close()
+
+        innudation_map = innudation_map.rio.set_spatial_dims('lon', 'lat')
+        innudation_map.rio.set_crs("epsg:4326")
+        innudation_map.rio.to_raster("output/output.tiff")
+
+        nc_file.close()
 
-    
     return folder_name
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FIER asset tools')
+    parser.add_argument('command', choices=['bundle'])
+    parser.add_argument('region')
+    parser.add_argument('--resolution', default=None)
+    parser.add_argument('--encoding', choices=encodings, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'bundle':
+        manifest = build_bundle(args.region, args.resolution, args.encoding)
+        print('%s bundle %s (%s, %d modes, %d pixels)'%(args.region, bundle_dir(args.region, args.resolution) + manifest['data_file'],
+                                                     manifest['resolution'], len(manifest['modes']), manifest['arrays']['index']['shape'][0]))